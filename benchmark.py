@@ -0,0 +1,320 @@
+"""
+Benchmarks for scrape.py, run on synthetic fftoday pages so that the numbers are reproducible and no
+requests are made to the real site.
+
+    python benchmark.py --profiles 1000 --max-years 6 --engine lxml --processes 4 --download
+
+The pages are generated in a temporary directory (--keep to leave it there). Then each of these
+runs in a process of its own, so that its peak memory is its own:
+
+    Downloader.download_player_profiles  (with --download, against a local stub HTTP server)
+    Scraper.scrape_player_listings
+    Scraper.scrape_player_profiles
+    Cleaner.clean_data
+
+and the time, throughput and peak RSS of each is printed. --compare-engines also checks that every
+parser engine writes exactly the same files as the 'soup' engine. --page-store packed runs it all on
+pages packed into segment files instead of a file per page.
+"""
+
+from multiprocessing import Process, Queue
+from Queue import Empty
+import BaseHTTPServer
+import SocketServer
+import threading
+import argparse
+import filecmp
+import resource
+import tempfile
+import traceback
+import random
+import shutil
+import time
+import os
+
+import scrape
+
+SITE_URL = 'http://fftoday.com'
+POSITIONS = ['QB','RB','WR','TE','K','DL','LB','DB']
+TEAMS = ['ARI','ATL','BAL','BUF','CAR','CHI','CIN','CLE','DAL','DEN','DET','GB','HOU','IND','JAC','KC',
+         'MIA','MIN','NE','NO','NYG','NYJ','OAK','PHI','PIT','SD','SEA','SF','STL','TB','TEN','WAS']
+SEASON_COLUMNS = [('Passing',['Comp','Att','Pct','Yard','TD','INT']),
+                  ('Rushing',['Att','Yard','Avg','TD']),
+                  ('Receiving',['Target','Rec','Yard','Avg','TD'])]
+GAMELOG_COLUMNS = [('Rushing',['Att','Yard','Avg','TD']),
+                   ('Receiving',['Target','Rec','Yard','Avg','TD'])]
+LAST_SEASON = 2015
+
+
+class PageGenerator:
+    """
+    Writes player listing and profile pages laid out the way fftoday's are, as far as the Scraper is
+    concerned: the listing links and the player info in the 8th table, a season stats table, and a
+    'YYYY Gamelog Stats' table followed by a nested gamelog table for each season.
+    """
+    def __init__(self,seed=0,max_years=4):
+        self.random = random.Random(seed)
+        self.max_years = max_years
+
+    def _nav_tables(self):
+        # the layout tables that come before the interesting one
+        return ''.join(['<table><tr><td><a href="/nav/%d">Menu %d</a></td></tr></table>' % (i,i) for i in range(6)])
+
+    def _page(self,title,content):
+        return ('<html><head><title>%s</title></head><body><table><tr><td>%s%s</td></tr></table></body></html>'
+                % (title,self._nav_tables(),content))
+
+    def listing_page(self,players):
+        links = ''.join(['<a href="%s">%s, %s</a><br/>' % (href,last,first) for href, first, last in players])
+        return self._page('Player Stats - FF Today','<table><tr><td class="bodycontent">%s</td></tr></table>' % links)
+
+    def _stat(self):
+        roll = self.random.random()
+        if roll < 0.05:
+            return '-'
+        if roll < 0.25:
+            return '%.1f' % (self.random.random() * 20)
+        if roll < 0.3:
+            return '%.1f%%' % (self.random.random() * 100)
+        return '{:,}'.format(self.random.randint(0,2000))
+
+    def _header_rows(self,leading,groups):
+        super_headers = '<td colspan="%d"></td>' % len(leading)
+        super_headers += ''.join(['<td colspan="%d">%s</td>' % (len(names),group) for group, names in groups])
+        headers = ''.join(['<td>%s</td>' % name for name in leading])
+        headers += ''.join(['<td>%s</td>' % name for group, names in groups for name in names])
+        return '<tr>%s</tr><tr>%s</tr>' % (super_headers,headers)
+
+    def _row(self,leading,groups):
+        cells = list(leading) + [self._stat() for group, names in groups for name in names]
+        return '<tr>%s</tr>' % ''.join(['<td>%s</td>' % cell for cell in cells])
+
+    def profile_page(self,first,last,position,team,seasons):
+        info = ('<strong>DOB:</strong> %s %d, %d<br/><strong>Age:</strong> %d<br/><strong>Ht:</strong> %d\'%d"<br/>'
+                '<strong>Wt:</strong> %d<br/><strong>College:</strong> Texas A&amp;M<br/><strong>Draft:</strong> %d / Round %d (%d) %s'
+                % (self.random.choice(['January','May','August','December']),self.random.randint(1,28),
+                   self.random.randint(1975,1995),self.random.randint(21,40),self.random.randint(5,6),
+                   self.random.randint(0,11),self.random.randint(160,330),self.random.randint(1995,2015),
+                   self.random.randint(1,7),self.random.randint(1,32),self.random.choice(TEAMS)))
+        content = '<table><tr><td class="bodycontent"><strong>%s %s</strong><br/>%s</td></tr></table>' % (first,last,info)
+        rows = ''.join([self._row([season,team],SEASON_COLUMNS) for season in seasons])
+        content += '<table><tr><td><strong>Season Stats</strong></td></tr></table>'
+        content += '<table>%s%s</table>' % (self._header_rows(['Season','Team'],SEASON_COLUMNS),rows)
+        for season in seasons:
+            rows = ''
+            for week in range(1,18):
+                result = '%s %d-%d' % (self.random.choice('WL'),self.random.randint(0,45),self.random.randint(0,45))
+                rows += self._row([str(week),self.random.choice(['','@ ']) + self.random.choice(TEAMS),result],GAMELOG_COLUMNS)
+            content += '<table><tr><td><strong>%s Gamelog Stats</strong></td></tr></table>' % season
+            content += ('<table><tr><td><table>%s%s</table></td></tr></table>'
+                        % (self._header_rows(['Wk','Opp','Result'],GAMELOG_COLUMNS),rows))
+        return self._page('%s %s %s, %s - FF Today' % (position,first,last,team),content)
+
+    def _save(self,directory,url,page):
+        # the same file name the Downloader would use
+        with open(os.path.join(directory,url.replace('/','_') + '.html'),'w') as f:
+            f.write(page)
+
+    def generate(self,directory,profiles):
+        listings_dir = os.path.join(directory,scrape.PLAYER_LISTINGS_DIR)
+        profiles_dir = os.path.join(directory,scrape.PLAYER_PROFILES_DIR)
+        for path in [listings_dir,profiles_dir]:
+            os.makedirs(path)
+        players_by_position = dict((position,[]) for position in POSITIONS)
+        for number in range(profiles):
+            player_number = 1000 + number
+            first, last = 'First%d' % player_number, 'Last%d' % player_number
+            href = '/stats/players/%d/%s_%s' % (player_number,first,last)
+            position = self.random.choice(POSITIONS)
+            players_by_position[position].append((href,first,last))
+            if self.random.random() < 0.05:
+                # some players are listed under two positions
+                players_by_position[self.random.choice(POSITIONS)].append((href,first,last))
+            first_season = LAST_SEASON - self.random.randint(0,self.max_years - 1)
+            seasons = [str(season) for season in range(first_season,LAST_SEASON + 1)]
+            page = self.profile_page(first,last,position,self.random.choice(TEAMS),seasons)
+            self._save(profiles_dir,SITE_URL + href,page)
+        for position in POSITIONS:
+            page = self.listing_page(players_by_position[position])
+            self._save(listings_dir,SITE_URL + '/stats/players?Pos=' + position,page)
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # serves the generated pages, by the path they were generated for
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self,*args):
+        pass
+
+    def do_GET(self):
+        name = (SITE_URL + self.path).replace('/','_') + '.html'
+        for directory in [scrape.PLAYER_LISTINGS_DIR,scrape.PLAYER_PROFILES_DIR]:
+            path = os.path.join(self.server.site_dir,directory,name)
+            if os.path.exists(path):
+                with open(path,'r') as f:
+                    page = f.read()
+                self.send_response(200)
+                self.send_header('Content-Type','text/html')
+                self.send_header('Content-Length',str(len(page)))
+                self.end_headers()
+                self.wfile.write(page)
+                return
+        self.send_response(404)
+        self.send_header('Content-Length','0')
+        self.end_headers()
+
+
+class StubServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self,site_dir):
+        BaseHTTPServer.HTTPServer.__init__(self,('127.0.0.1',0),StubHandler)
+        self.site_dir = site_dir
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+
+def peak_rss():
+    # in MB, of this process and any pool processes it waited for (ru_maxrss is in KB on Linux)
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return usage / 1024.0
+
+
+def pack_pages(work_dir):
+    # move the generated pages into packed page stores
+    for directory in [scrape.PLAYER_LISTINGS_DIR,scrape.PLAYER_PROFILES_DIR]:
+        directory = os.path.join(work_dir,directory)
+        pages = scrape.DirectoryPageStore(directory)
+        names = pages.names()
+        scrape.copy_pages(pages,scrape.PackedPageStore(directory))
+        for name in names:
+            os.remove(os.path.join(directory,name))
+
+
+def count_pages(args,directory):
+    return len(scrape.PAGE_STORES[args.page_store](directory).names())
+
+
+def download_stage(args,site_dir):
+    server = StubServer(site_dir)
+    downloader = scrape.Downloader(args.page_store)
+    downloader.base_url = server.url()
+    downloader.download_player_profiles(delay=0,workers=args.workers)
+    return count_pages(args,downloader.player_profiles_dir)
+
+
+def scrape_listings_stage(args,site_dir):
+    return len(scrape.Scraper(args.engine,args.page_store).scrape_player_listings())
+
+
+def scrape_profiles_stage(args,site_dir):
+    scrape.Scraper(args.engine,args.page_store).scrape_player_profiles(processes=args.processes)
+    return count_pages(args,scrape.PLAYER_PROFILES_DIR)
+
+
+def clean_stage(args,site_dir):
+    scrape.Cleaner().clean_data()
+    paths = scrape.Cleaner().get_stat_file_paths()
+    return sum(1 for path in paths for line in open(path,'r'))
+
+
+def _run_stage(stage,args,directory,site_dir,results):
+    # a failing stage sends its traceback back instead of results, so the parent isn't left waiting
+    try:
+        os.chdir(directory)
+        start = time.time()
+        items = stage(args,site_dir)
+        results.put((time.time() - start,items,peak_rss()))
+    except BaseException:
+        results.put(traceback.format_exc())
+        raise
+
+
+def run_stage(name,stage,args,directory,site_dir):
+    results = Queue()
+    process = Process(target=_run_stage,args=(stage,args,directory,site_dir,results))
+    process.start()
+    result = None
+    while result is None:
+        try:
+            result = results.get(timeout=1)
+        except Empty:
+            if not process.is_alive():
+                process.join()
+                try:
+                    result = results.get(timeout=1) # it may have put its result just before exiting
+                except Empty: # killed before it could say anything
+                    raise Exception('%s died with exit code %s' % (name,process.exitcode))
+    process.join()
+    if isinstance(result,str):
+        raise Exception('%s failed:\n%s' % (name,result))
+    seconds, items, rss = result
+    print '%-40s %9.2fs %8d items %10.1f items/s %8.1f MB peak RSS' % (name,seconds,items,items / seconds,rss)
+
+
+def compare_engines(args,directory):
+    # every engine should write exactly the files the 'soup' engine does
+    outputs = {}
+    for engine in sorted(scrape.ENGINES):
+        work_dir = os.path.join(directory,'engine_' + engine)
+        shutil.copytree(os.path.join(directory,'site'),work_dir)
+        if args.page_store == 'packed':
+            pack_pages(work_dir)
+        engine_args = argparse.Namespace(**vars(args))
+        engine_args.engine = engine
+        run_stage('scrape_player_profiles (%s)' % engine,scrape_profiles_stage,engine_args,work_dir,None)
+        outputs[engine] = os.path.join(work_dir,scrape.SCRAPED_PLAYER_INFO)
+    files = [scrape.SCRAPED_PLAYER_INFO_FILE,scrape.SCRAPED_SEASON_STATS_FILE,scrape.SCRAPED_GAMELOG_STATS_FILE]
+    for engine in sorted(outputs):
+        match, mismatch, errors = filecmp.cmpfiles(outputs['soup'],outputs[engine],files,shallow=False)
+        print '%-8s %s' % (engine,'same output as soup' if not mismatch and not errors else 'DIFFERENT: %s' % (mismatch + errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profiles',type=int,default=1000,help='number of player profiles to generate')
+    parser.add_argument('--max-years',type=int,default=4,help='most gamelog seasons per player')
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--engine',default='soup',choices=sorted(scrape.ENGINES))
+    parser.add_argument('--processes',type=int,default=1,help='for scrape_player_profiles')
+    parser.add_argument('--workers',type=int,default=4,help='for download_player_profiles')
+    parser.add_argument('--page-store',default='directory',choices=sorted(scrape.PAGE_STORES))
+    parser.add_argument('--download',action='store_true',help='also time the Downloader against a stub server')
+    parser.add_argument('--compare-engines',action='store_true')
+    parser.add_argument('--keep',action='store_true',help="don't delete the generated files")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='scrape_benchmark_')
+    try:
+        site_dir = os.path.join(directory,'site')
+        start = time.time()
+        PageGenerator(args.seed,args.max_years).generate(site_dir,args.profiles)
+        print 'generated %d profiles in %.1fs (%s)' % (args.profiles,time.time() - start,directory)
+
+        if args.download:
+            download_dir = os.path.join(directory,'download')
+            os.mkdir(download_dir)
+            shutil.copytree(os.path.join(site_dir,scrape.PLAYER_LISTINGS_DIR),os.path.join(download_dir,scrape.PLAYER_LISTINGS_DIR))
+            if args.page_store == 'packed':
+                pack_pages(download_dir)
+            run_stage('Downloader.download_player_profiles',download_stage,args,download_dir,site_dir)
+        work_dir = os.path.join(directory,'work')
+        shutil.copytree(site_dir,work_dir)
+        if args.page_store == 'packed':
+            pack_pages(work_dir)
+        run_stage('Scraper.scrape_player_listings',scrape_listings_stage,args,work_dir,site_dir)
+        run_stage('Scraper.scrape_player_profiles',scrape_profiles_stage,args,work_dir,site_dir)
+        run_stage('Cleaner.clean_data (rows)',clean_stage,args,work_dir,site_dir)
+        if args.compare_engines:
+            compare_engines(args,directory)
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
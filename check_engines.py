@@ -0,0 +1,88 @@
+"""
+Checks that every parser engine in scrape.ENGINES scrapes the checked-in fixture pages into exactly
+the expected files.
+
+    python check_engines.py            # exit status 1 if any engine's output differs
+    python check_engines.py --update   # rewrite the expected files with the 'soup' engine's output
+
+fixtures/player_listings and fixtures/player_profiles are trimmed fftoday pages, with the things the
+engines have to treat the way BeautifulSoup does: script and style contents, comments, entities,
+attributes with quotes in them, empty elements, and non-ASCII text. fixtures/expected holds the
+listing records and the three scraped files, as written by the 'soup' engine, the original one.
+"""
+
+import argparse
+import difflib
+import tempfile
+import shutil
+import sys
+import os
+
+import scrape
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),'fixtures')
+EXPECTED_DIR = os.path.join(FIXTURES_DIR,'expected')
+PLAYER_LISTINGS_FILE = 'player_listings.dat'
+OUTPUT_FILES = [PLAYER_LISTINGS_FILE,scrape.SCRAPED_PLAYER_INFO_FILE,scrape.SCRAPED_SEASON_STATS_FILE,
+                scrape.SCRAPED_GAMELOG_STATS_FILE]
+
+
+def scrape_fixtures(engine,directory):
+    # scrape the fixture pages in 'directory' with the engine, and return the output directory
+    for pages in [scrape.PLAYER_LISTINGS_DIR,scrape.PLAYER_PROFILES_DIR]:
+        shutil.copytree(os.path.join(FIXTURES_DIR,pages),os.path.join(directory,pages))
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        scraper = scrape.Scraper(engine)
+        scraper.scrape_player_profiles()
+        with open(os.path.join(scrape.SCRAPED_PLAYER_INFO,PLAYER_LISTINGS_FILE),'w') as f:
+            for record in scraper.scrape_player_listings():
+                f.write(('\t'.join(record) + '\n').encode('utf-8'))
+    finally:
+        os.chdir(cwd)
+    return os.path.join(directory,scrape.SCRAPED_PLAYER_INFO)
+
+
+def compare(output_dir,engine):
+    # print a diff for each file that isn't as expected, and return whether they all are
+    same = True
+    for file in OUTPUT_FILES:
+        with open(os.path.join(EXPECTED_DIR,file),'r') as f:
+            expected = f.read().splitlines(True)
+        with open(os.path.join(output_dir,file),'r') as f:
+            actual = f.read().splitlines(True)
+        if actual != expected:
+            same = False
+            sys.stdout.writelines(difflib.unified_diff(expected,actual,'expected/' + file,engine + '/' + file))
+    return same
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--update',action='store_true',help="rewrite the expected files from the 'soup' engine")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='check_engines_')
+    try:
+        if args.update:
+            output_dir = scrape_fixtures('soup',os.path.join(directory,'soup'))
+            if not os.path.exists(EXPECTED_DIR):
+                os.mkdir(EXPECTED_DIR)
+            for file in OUTPUT_FILES:
+                shutil.copy(os.path.join(output_dir,file),os.path.join(EXPECTED_DIR,file))
+            print 'updated %s' % EXPECTED_DIR
+            return 0
+        failed = []
+        for engine in sorted(scrape.ENGINES):
+            if compare(scrape_fixtures(engine,os.path.join(directory,engine)),engine):
+                print '%-8s same output as expected' % engine
+            else:
+                print '%-8s DIFFERENT' % engine
+                failed.append(engine)
+        return 1 if failed else 0
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""
+Checks Pipeline.run end to end, on synthetic fftoday pages (benchmark.PageGenerator) served by a local
+stub server (benchmark.StubServer), including the ways a run can fail:
+
+    python check_pipeline.py --profiles 60 --processes 2
+
+    output      the pipeline writes the same rows as the Downloader, Scraper and Cleaner run one
+                after the other
+    writer      a store that fails partway through makes run() raise, instead of hanging
+    download    a profile page that can't be saved makes run() raise, instead of the run leaving the
+                profile out and returning normally
+    rerun       running the same Pipeline twice, with the parse cache on, counts each run's
+                unscrapable profiles on their own and keeps the cache within its size limit
+
+Each check runs in a directory of its own. The exit status is 1 if any check fails.
+"""
+
+import argparse
+import tempfile
+import threading
+import traceback
+import shutil
+import errno
+import sys
+import os
+
+import benchmark
+import scrape
+
+OUTPUT_FILES = [scrape.SCRAPED_PLAYER_INFO_FILE,scrape.SCRAPED_SEASON_STATS_FILE,scrape.SCRAPED_GAMELOG_STATS_FILE]
+
+
+class FailingStore(scrape.FlatFileStore):
+    # a FlatFileStore whose disk fills up on the 5th player
+    def __init__(self,scraper,flush_every=10000):
+        scrape.FlatFileStore.__init__(self,scraper,flush_every)
+        self.players_written = 0
+
+    def write_player(self,player_record):
+        self.players_written += 1
+        if self.players_written == 5:
+            raise IOError(errno.ENOSPC,'No space left on device')
+        scrape.FlatFileStore.write_player(self,player_record)
+
+
+def read_rows(directory):
+    # the rows of each output file, sorted, since the pipeline writes them in download order
+    rows = {}
+    for file in OUTPUT_FILES:
+        with open(os.path.join(directory,scrape.SCRAPED_PLAYER_INFO,file),'r') as f:
+            rows[file] = sorted(f.read().splitlines())
+    return rows
+
+
+def run_pipeline(pipeline,server,args,timeout,**options):
+    # run() in a thread of its own, so that a hang is reported instead of hanging the check.
+    # Returns the exception run() raised, or None.
+    pipeline.downloader.base_url = server.url()
+    errors = []
+    def run():
+        try:
+            pipeline.run(delay=0,workers=args.workers,processes=args.processes,retries=0,**options)
+        except Exception as e:
+            errors.append(e)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    pipeline.downloader.session.close() # so the server's keep-alive threads can finish
+    if thread.is_alive():
+        raise Exception('run() did not return within %ds' % timeout)
+    return errors[0] if errors else None
+
+
+def check_output(args,server,directory):
+    os.chdir(os.path.join(directory,'batch'))
+    downloader = scrape.Downloader()
+    downloader.base_url = server.url()
+    downloader.download_player_listings(delay=0)
+    downloader.download_player_profiles(delay=0,workers=args.workers)
+    downloader.session.close()
+    scrape.Scraper().scrape_player_profiles(processes=args.processes)
+    scrape.Cleaner().clean_data()
+
+    os.chdir(os.path.join(directory,'output'))
+    pipeline = scrape.Pipeline()
+    error = run_pipeline(pipeline,server,args,args.timeout)
+    if error is not None:
+        raise error
+    if pipeline.failures:
+        raise Exception('%d profiles could not be scraped' % pipeline.failures)
+    batch, piped = read_rows(os.path.join(directory,'batch')), read_rows(os.path.join(directory,'output'))
+    for file in OUTPUT_FILES:
+        if piped[file] != batch[file]:
+            raise Exception('%s: %d rows, %d in batch mode' % (file,len(piped[file]),len(batch[file])))
+    return '%d players' % len(piped[scrape.SCRAPED_PLAYER_INFO_FILE])
+
+
+def check_writer(args,server,directory):
+    os.chdir(os.path.join(directory,'writer'))
+    scrape.STORES['failing'] = FailingStore
+    try:
+        error = run_pipeline(scrape.Pipeline(),server,args,args.timeout,store='failing')
+    finally:
+        del scrape.STORES['failing']
+    if not isinstance(error,IOError) or error.errno != errno.ENOSPC:
+        raise Exception('run() should have raised the store\'s IOError, not %r' % error)
+    return 'raised %r' % error
+
+
+def check_download(args,server,directory):
+    os.chdir(os.path.join(directory,'download'))
+    pipeline = scrape.Pipeline()
+    save_page = pipeline.downloader._save_page
+    saved = [0]
+    def failing_save_page(page,url,destination_directory):
+        # every 7th profile hits a full disk
+        if destination_directory == pipeline.downloader.player_profiles_dir:
+            saved[0] += 1
+            if saved[0] % 7 == 0:
+                raise IOError(errno.ENOSPC,'No space left on device')
+        save_page(page,url,destination_directory)
+    pipeline.downloader._save_page = failing_save_page
+    error = run_pipeline(pipeline,server,args,args.timeout)
+    if not isinstance(error,IOError) or error.errno != errno.ENOSPC:
+        raise Exception('run() should have raised the page store\'s IOError, not %r' % error)
+    return 'raised %r' % error
+
+
+def check_rerun(args,server,directory):
+    # a copy of the site with one profile that can't be scraped
+    site_dir = os.path.join(directory,'rerun_site')
+    shutil.copytree(server.site_dir,site_dir)
+    profiles_dir = os.path.join(site_dir,scrape.PLAYER_PROFILES_DIR)
+    with open(os.path.join(profiles_dir,sorted(os.listdir(profiles_dir))[0]),'w') as f:
+        f.write('<html><body>Player not found</body></html>')
+    server.site_dir, original_site_dir = site_dir, server.site_dir
+    try:
+        os.chdir(os.path.join(directory,'rerun'))
+        pipeline = scrape.Pipeline()
+        pipeline.scraper.parse_cache_max_bytes = max_bytes = 8*1024
+        for run in [1,2]:
+            error = run_pipeline(pipeline,server,args,args.timeout,use_cache=True)
+            if error is not None:
+                raise error
+            if pipeline.failures != 1:
+                raise Exception('run %d counted %d unscrapable profiles, not 1' % (run,pipeline.failures))
+            cache_dir = pipeline.scraper.parse_cache_dir
+            cache_size = sum(os.path.getsize(os.path.join(cache_dir,file)) for file in os.listdir(cache_dir))
+            if cache_size > max_bytes:
+                raise Exception('run %d left %d bytes in the parse cache, more than %d' % (run,cache_size,max_bytes))
+    finally:
+        server.site_dir = original_site_dir
+    return '1 failure each run, %d bytes cached' % cache_size
+
+
+CHECKS = [('output',check_output),
+          ('writer',check_writer),
+          ('download',check_download),
+          ('rerun',check_rerun)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profiles',type=int,default=60,help='number of player profiles to generate')
+    parser.add_argument('--processes',type=int,default=2,help="Pipeline.run's parser processes")
+    parser.add_argument('--workers',type=int,default=4,help="Pipeline.run's download threads")
+    parser.add_argument('--timeout',type=int,default=120,help='seconds to wait for each run')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='check_pipeline_')
+    cwd = os.getcwd()
+    try:
+        site_dir = os.path.join(directory,'site')
+        benchmark.PageGenerator().generate(site_dir,args.profiles)
+        server = benchmark.StubServer(site_dir)
+        failed = []
+        for name, check in CHECKS:
+            for path in [name,'batch'] if name == 'output' else [name]:
+                os.mkdir(os.path.join(directory,path))
+            try:
+                print '%-10s ok: %s' % (name,check(args,server,directory))
+            except Exception:
+                print '%-10s FAILED\n%s' % (name,traceback.format_exc())
+                failed.append(name)
+            finally:
+                os.chdir(cwd)
+        server.shutdown()
+        server.server_close()
+        return 1 if failed else 0
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    sys.exit(main())
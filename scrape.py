@@ -1,19 +1,64 @@
 
 """
 The task of scraping football data from http://fftoday.com/ is split into
-three jobs <=> three classes:
+three jobs <=> three main classes:
 
 1) Downloader: download and save the html files
 2) Scraper: parsing the html files to extract the data
 3) Cleaner: clean up the data
 
+The rest are their helpers, and a few ways of running or using them:
+
+- HTTPSession, RateLimiter, Manifest: the Downloader's connections, pacing and record of fetches
+- DirectoryPageStore, PackedPageStore (PAGE_STORES): where the html files are saved
+- SoupEngine, LxmlEngine (ENGINES), TableIndex: the Scraper's parsers
+- PlayerIndex: the players in the listings, one per profile
+- PlayerRecord, StatRows, ParseCache: the scraped records, and a cache of them
+- FlatFileStore, RecordWriter, SQLiteStore (STORES): where the scraped records are written
+- ColumnarExporter, StatsStore: the cleaned stats as .npy columns, or in memory for queries
+- Pipeline: runs the three jobs at the same time
+- ShardedCrawl: splits the three jobs over several machines
+- Metrics (METRICS): where the time goes
+
 """
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer, UnicodeDammit
+from lxml import etree
+import lxml.html
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+from cStringIO import StringIO
+from contextlib import contextmanager
+import threading
+import Queue
+import sys
+import itertools
+import random
+import bisect
+import heapq
+import tempfile
+import shutil
+import httplib
+import urlparse
+import urllib
 import urllib2
+import hashlib
+import socket
+import cPickle
+import cProfile
+import csv
+import sqlite3
+import json
+import zlib
+import re
 import time
 import os
 
+try:
+    import numpy
+except ImportError: # only needed by the ColumnarExporter
+    numpy = None
+
 PLAYER_LISTINGS_DIR = 'player_listings'
 PLAYER_PROFILES_DIR = 'player_profiles'
 SCRAPED_PLAYER_INFO = 'scraped_player_info'
@@ -21,6 +66,594 @@ SCRAPED_PLAYER_INFO = 'scraped_player_info'
 SCRAPED_PLAYER_INFO_FILE = 'scraped_player_info.dat'
 SCRAPED_SEASON_STATS_FILE = 'scraped_season_stats.dat'
 SCRAPED_GAMELOG_STATS_FILE = 'scraped_gamelog_stats.dat'
+SCRAPED_DATABASE_FILE = 'scraped_player_info.db'
+COLUMNAR_DIR = 'columnar'
+
+DOWNLOAD_MANIFEST_FILE = 'download_manifest.jsonl'
+PARSE_CACHE_DIR = 'parse_cache'
+
+# Bump this whenever a change to the Scraper changes the records it produces, so that the records
+# cached by the previous version are not reused.
+PARSER_VERSION = 3
+
+# the heading of the table before each season's gamelog table
+GAMELOG_PATTERN = re.compile(r'(\d{4}) Gamelog Stats')
+
+# fftoday's own player number, from a profile file name like http:__fftoday.com_stats_players_11178_Tom_Brady.html
+PLAYER_ID_PATTERN = re.compile(r'_players_(\d+)_')
+
+
+def ends_cut_off(path):
+    # does the file end partway through a line? A crash while appending to a journal leaves it so.
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return False
+    with open(path,'r') as f:
+        f.seek(-1,os.SEEK_END)
+        return f.read(1) != '\n'
+
+
+def shard_for(href,num_shards):
+    # The shard a player's profile belongs to. md5 rather than hash(), so that every machine agrees.
+    return int(hashlib.md5(href).hexdigest(),16) % num_shards
+
+
+class Metrics:
+    """
+    Collects timings from the Downloader, Scraper and Cleaner, so that we can see where the time goes:
+
+    download  fetch/error                per url: latency and bytes
+    scrape    parse, scrape_player_information, scrape_season_stats, scrape_gamelog_stats
+                                         per profile: time spent in each step (cache_hit when the
+                                         parse cache made the parse unnecessary)
+    clean     clean_file, clean_records  per file or batch: time, bytes and rows
+
+    Every measurement is an event: (stage, name, label, seconds, bytes, items). The events aren't
+    kept, since a long crawl makes millions of them. Instead each stage and name keeps running totals
+    and a random sample of at most 'sample_size' timings for the percentiles, so memory use doesn't
+    grow with the crawl. write_json() saves a summary per stage and name: count, total, mean, median,
+    95th percentile and max time, bytes and items per second (the median and 95th percentile are
+    exact up to sample_size events, and estimates after that).
+    stream_csv() writes every event to a csv file from then on, as it's recorded.
+    profile() runs a block of code under cProfile and saves the stats for pstats or snakeviz.
+
+    With keep_events=True the events are also kept in 'events', which is how a worker process hands
+    the events of one task back to the main process's Metrics (see extend).
+
+    All three classes record into the module's METRICS object unless given another one.
+    """
+    fields = ['stage','name','label','seconds','bytes','items']
+
+    def __init__(self,keep_events=False,sample_size=1000):
+        self.keep_events = keep_events
+        self.sample_size = sample_size
+        self.events = []
+        self.groups = {} # (stage, name) -> [count, total seconds, max seconds, bytes, items, sample of seconds]
+        self.random = random.Random(0)
+        self.csv_file = None
+        self.csv_writer = None
+        self.lock = threading.Lock()
+
+    def _add(self,event):
+        stage, name, label, seconds, bytes, items = event
+        group = self.groups.get((stage,name))
+        if group is None:
+            group = self.groups[(stage,name)] = [0,0.0,seconds,0,0,[]]
+        group[0] += 1
+        group[1] += seconds
+        group[2] = max(group[2],seconds)
+        group[3] += bytes
+        group[4] += items
+        # reservoir sampling: every event has the same chance of being in the sample
+        sample = group[5]
+        if len(sample) < self.sample_size:
+            sample.append(seconds)
+        else:
+            i = self.random.randint(0,group[0] - 1)
+            if i < self.sample_size:
+                sample[i] = seconds
+        if self.keep_events:
+            self.events.append(event)
+        if self.csv_writer is not None:
+            self.csv_writer.writerow([unicode(value).encode('utf-8') for value in event])
+
+    def record(self,stage,name,seconds,bytes=0,items=1,label=''):
+        with self.lock:
+            self._add((stage,name,unicode(label),seconds,bytes,items))
+
+    def extend(self,events):
+        # add events recorded elsewhere, e.g. in a worker process
+        with self.lock:
+            for event in events:
+                self._add(event)
+
+    @contextmanager
+    def timer(self,stage,name,label=''):
+        start = time.time()
+        yield
+        self.record(stage,name,time.time() - start,label=label)
+
+    @contextmanager
+    def profile(self,path):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+
+    def summary(self):
+        summary = []
+        with self.lock:
+            for (stage, name), (count, total, max_seconds, total_bytes, total_items, sample) in sorted(self.groups.items()):
+                seconds = sorted(sample)
+                summary.append({'stage': stage,
+                                'name': name,
+                                'count': count,
+                                'total_seconds': total,
+                                'mean_seconds': total / count,
+                                'median_seconds': seconds[(len(seconds) - 1) // 2],
+                                'p95_seconds': seconds[int(0.95 * (len(seconds) - 1))],
+                                'max_seconds': max_seconds,
+                                'bytes': total_bytes,
+                                'items': total_items,
+                                'bytes_per_second': total_bytes / total if total else None,
+                                'items_per_second': total_items / total if total else None})
+        return summary
+
+    def write_json(self,path):
+        with open(path,'w') as f:
+            json.dump({'summary': self.summary()},f,indent=1)
+
+    def stream_csv(self,path):
+        # write the events recorded from now on to a csv file, as they come
+        with self.lock:
+            self._close_csv()
+            self.csv_file = open(path,'wb')
+            self.csv_writer = csv.writer(self.csv_file)
+            self.csv_writer.writerow(self.fields)
+
+    def _close_csv(self):
+        if self.csv_file is not None:
+            self.csv_file.close()
+        self.csv_file = None
+        self.csv_writer = None
+
+    def close(self):
+        with self.lock:
+            self._close_csv()
+
+
+METRICS = Metrics()
+
+
+class RateLimiter:
+    """
+    A token bucket shared by every thread of the Downloader, so that the total request rate stays
+    polite no matter how many workers are running.
+
+    rate:     tokens (requests) added to the bucket per second
+    capacity: the largest burst of requests allowed after an idle period
+    """
+    def __init__(self,rate,capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # block until a token is available, then take it.
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HTTPSession:
+    """
+    A small pool of persistent (keep-alive) HTTP connections, so that the thousands of requests made to
+    the same host don't each pay for a new TCP connection. Responses are requested gzipped and are
+    decompressed transparently.
+
+    open() takes a urllib2.Request and behaves like urllib2.urlopen: it returns a file-like response
+    (read, info, getcode), follows 301/302/303/307 redirects (at most 'max_redirects' of them), raises
+    urllib2.HTTPError for 4xx/5xx responses and for any other 3xx but 304 Not Modified, and raises
+    urllib2.URLError when the connection fails.
+    """
+    redirect_codes = (301,302,303,307)
+    max_redirects = 5
+
+    def __init__(self,pool_size=8,timeout=30):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.idle = {} # (scheme,host) -> list of idle connections
+        self.lock = threading.Lock()
+
+    def _get_connection(self,scheme,host):
+        # reuse an idle connection if there is one. The second value says whether it was reused.
+        with self.lock:
+            idle = self.idle.get((scheme,host))
+            if idle:
+                return idle.pop(), True
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host,timeout=self.timeout), False
+        return httplib.HTTPConnection(host,timeout=self.timeout), False
+
+    def _release_connection(self,scheme,host,connection):
+        with self.lock:
+            idle = self.idle.setdefault((scheme,host),[])
+            if len(idle) < self.pool_size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def _decode(self,body,response):
+        encoding = response.getheader('content-encoding','').lower()
+        if encoding in ('gzip','x-gzip'):
+            return zlib.decompress(body,16 + zlib.MAX_WBITS)
+        if encoding == 'deflate':
+            return zlib.decompress(body)
+        return body
+
+    def _fetch(self,method,url,data,headers):
+        # one request and its (decoded) body, on a pooled connection
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        while True:
+            connection, reused = self._get_connection(parts.scheme,parts.netloc)
+            try:
+                connection.request(method,path,data,headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (socket.error,httplib.HTTPException) as e:
+                connection.close()
+                # the server may have closed an idle keep-alive connection. Try again on a fresh one.
+                if reused:
+                    continue
+                raise urllib2.URLError(e)
+            break
+        if response.will_close:
+            connection.close()
+        else:
+            self._release_connection(parts.scheme,parts.netloc,connection)
+        try:
+            body = self._decode(body,response)
+        except zlib.error as e:
+            raise urllib2.URLError(e)
+        return response, body
+
+    def open(self,request):
+        url = request.get_full_url()
+        method = request.get_method()
+        data = request.get_data()
+        headers = dict(request.header_items())
+        headers['Accept-Encoding'] = 'gzip'
+        headers['Connection'] = 'keep-alive'
+        for redirect in range(self.max_redirects + 1):
+            response, body = self._fetch(method,url,data,headers)
+            location = response.getheader('location')
+            if response.status not in self.redirect_codes or location is None:
+                break
+            if redirect == self.max_redirects:
+                raise urllib2.HTTPError(url,response.status,'too many redirects',response.msg,StringIO(body))
+            # follow it the way urllib2 does: a 303, or a redirected POST, becomes a GET
+            url = urlparse.urljoin(url,location)
+            if response.status == 303 or (method == 'POST' and response.status != 307):
+                method, data = 'GET', None
+                headers.pop('Content-Type',None)
+                headers.pop('Content-Length',None)
+        if response.status >= 400 or (response.status >= 300 and response.status != 304):
+            raise urllib2.HTTPError(url,response.status,response.reason,response.msg,StringIO(body))
+        return urllib.addinfourl(StringIO(body),response.msg,url,response.status)
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for connection in idle:
+                    connection.close()
+            self.idle = {}
+
+
+class Manifest:
+    """
+    The Manifest records every page the Downloader has fetched, keyed by url:
+
+    file:           the name of the saved html file
+    status:         the http status of the last fetch (or 'error')
+    etag:           the ETag header, used for conditional requests
+    last_modified:  the Last-Modified header, used for conditional requests
+    hash:           sha1 of the page content
+    fetched:        when the url was last fetched (seconds since the epoch)
+    changed:        when the page content last changed
+
+    It's stored as an append-only journal, one json object per line, where the last line for a url wins.
+    A crashed crawl loses at most the line being written: a cut-off last line is skipped on load, and
+    the next line recorded starts on a line of its own. Passing max_age to download_player_profiles
+    then picks up where the crawl left off.
+    """
+    def __init__(self,path=DOWNLOAD_MANIFEST_FILE):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.cut_off = ends_cut_off(path)
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path,'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # a line cut short by a crash
+                self.entries[entry['url']] = entry
+
+    def get(self,url):
+        return self.entries.get(url)
+
+    def record(self,url,**fields):
+        with self.lock:
+            entry = dict(self.entries.get(url,{}))
+            entry.update(fields)
+            entry['url'] = url
+            self.entries[url] = entry
+            with open(self.path,'a') as f:
+                if self.cut_off:
+                    f.write('\n') # don't glue this line to a cut-off one
+                    self.cut_off = False
+                f.write(json.dumps(entry) + '\n')
+        return entry
+
+    def is_fresh(self,url,max_age):
+        # was the url fetched successfully in the last 'max_age' seconds?
+        entry = self.entries.get(url)
+        if entry is None or entry.get('status') not in (200,304):
+            return False
+        return time.time() - entry['fetched'] < max_age
+
+    def changed_since(self,since):
+        # the files whose content changed at or after 'since' (seconds since the epoch). Urls that
+        # have never been fetched successfully have no file, and are left out.
+        return [entry['file'] for entry in self.entries.values()
+                if 'file' in entry and 'changed' in entry and entry['changed'] >= since]
+
+    def compact(self):
+        # rewrite the journal with one line per url.
+        with self.lock:
+            temp_path = self.path + '.tmp'
+            with open(temp_path,'w') as f:
+                for url in sorted(self.entries):
+                    f.write(json.dumps(self.entries[url]) + '\n')
+            os.rename(temp_path,self.path)
+            self.cut_off = False
+
+
+class DirectoryPageStore:
+    """
+    Keeps each page in its own file in 'directory', named after the page. This is how the pages have
+    always been saved, and they can be opened and grepped as they are.
+
+    The page stores (see PAGE_STORES) all have these methods: exists, read, write, names,
+    iter_pages and close. Pages are named by Downloader._make_output_file.
+    """
+    def __init__(self,directory):
+        self.directory = directory
+
+    def _make_path(self,name):
+        return os.path.join(self.directory,name)
+
+    def exists(self,name):
+        return os.path.exists(self._make_path(name))
+
+    def read(self,name):
+        with open(self._make_path(name),'r') as f:
+            return f.read()
+
+    def write(self,name,page):
+        with open(self._make_path(name),'w') as f:
+            f.write(page)
+
+    def names(self):
+        if not os.path.exists(self.directory):
+            return []
+        return sorted(file for file in os.listdir(self.directory) if file.endswith('.html'))
+
+    def iter_pages(self,names=None):
+        # (name, page) for the given pages, or all of them, in order
+        for name in (self.names() if names is None else names):
+            yield name, self.read(name)
+
+    def close(self):
+        pass
+
+
+class PackedPageStore:
+    """
+    Packs the pages into a few large segment files instead of a file each. Every page is compressed
+    with zlib and appended to the current segment, and a new segment is started once the current one
+    is 'segment_size' bytes long.
+
+    The index (INDEX_FILE in the same directory) says where each page is. It's an append-only journal
+    like the Manifest, one json line per page written: name, segment, offset, length. The last line
+    for a name wins, so writing a page again appends a new copy, and compact() rewrites the segments
+    without the old copies. A page's bytes are written before its index line, so a crash can leave
+    unused bytes in a segment but never an index line pointing at a half-written page.
+
+    The index is loaded when the store is opened. Reading a page is one seek and one read, and
+    iter_pages keeps the segments open as it goes.
+    """
+    index_file = 'pages.idx'
+    segment_file = 'pages_%05d.seg'
+    segment_pattern = re.compile(r'pages_(\d{5})\.seg\Z')
+
+    def __init__(self,directory,segment_size=256*1024*1024,compression_level=6):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.compression_level = compression_level
+        self.lock = threading.Lock()
+        self.entries = {} # name -> (segment, offset, length)
+        self.segment_writer = None
+        self.index_writer = None
+        self._load()
+
+    def _make_path(self,file):
+        return os.path.join(self.directory,file)
+
+    def _make_segment_path(self,segment):
+        return self._make_path(self.segment_file % segment)
+
+    def _load(self):
+        path = self._make_path(self.index_file)
+        if not os.path.exists(path):
+            return
+        with open(path,'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # a line cut short by a crash
+                self.entries[entry['name'].encode('utf-8')] = (entry['segment'],entry['offset'],entry['length'])
+
+    def _open_index_writer(self):
+        path = self._make_path(self.index_file)
+        cut_off = ends_cut_off(path)
+        self.index_writer = open(path,'a')
+        if cut_off:
+            self.index_writer.write('\n') # don't glue the next line to a cut-off one
+
+    def _segments(self):
+        # the numbers of the segment files on disk
+        if not os.path.exists(self.directory):
+            return []
+        matches = map(self.segment_pattern.match,os.listdir(self.directory))
+        return sorted(int(match.group(1)) for match in matches if match)
+
+    def _open_segment_writer(self,segment):
+        self.segment = segment
+        self.segment_writer = open(self._make_segment_path(segment),'ab')
+        self.segment_writer.seek(0,os.SEEK_END)
+
+    def _append(self,data):
+        # append the compressed bytes to the current segment, and return where they went
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        if self.segment_writer is None:
+            # carry on with the last segment
+            self._open_segment_writer((self._segments() or [0])[-1])
+        offset = self.segment_writer.tell()
+        if offset > 0 and offset + len(data) > self.segment_size:
+            self.segment_writer.close()
+            self._open_segment_writer(self.segment + 1)
+            offset = self.segment_writer.tell()
+        self.segment_writer.write(data)
+        self.segment_writer.flush()
+        return self.segment, offset, len(data)
+
+    def _format_entry(self,name,entry):
+        segment, offset, length = entry
+        return json.dumps({'name': name, 'segment': segment, 'offset': offset, 'length': length}) + '\n'
+
+    def _record(self,name,entry):
+        if self.index_writer is None:
+            self._open_index_writer()
+        self.index_writer.write(self._format_entry(name,entry))
+        self.index_writer.flush()
+        self.entries[name] = entry
+
+    def _read_data(self,f,entry):
+        segment, offset, length = entry
+        f.seek(offset)
+        return f.read(length)
+
+    def exists(self,name):
+        return name in self.entries
+
+    def read(self,name):
+        entry = self.entries[name]
+        with open(self._make_segment_path(entry[0]),'rb') as f:
+            return zlib.decompress(self._read_data(f,entry))
+
+    def write(self,name,page):
+        data = zlib.compress(page,self.compression_level)
+        with self.lock:
+            self._record(name,self._append(data))
+
+    def names(self):
+        return sorted(self.entries)
+
+    def iter_pages(self,names=None):
+        # (name, page) for the given pages, or all of them, in order
+        files = {}
+        try:
+            for name in (self.names() if names is None else names):
+                entry = self.entries[name]
+                if entry[0] not in files:
+                    files[entry[0]] = open(self._make_segment_path(entry[0]),'rb')
+                yield name, zlib.decompress(self._read_data(files[entry[0]],entry))
+        finally:
+            for f in files.values():
+                f.close()
+
+    def _close_writers(self):
+        for writer in [self.segment_writer,self.index_writer]:
+            if writer is not None:
+                writer.close()
+        self.segment_writer = None
+        self.index_writer = None
+
+    def close(self):
+        with self.lock:
+            self._close_writers()
+
+    def compact(self):
+        # rewrite the pages into new segments, dropping the copies that have since been replaced
+        with self.lock:
+            self._close_writers()
+            old_segments = self._segments()
+            if not old_segments:
+                return
+            self._open_segment_writer(old_segments[-1] + 1)
+            entries = {}
+            files = {}
+            try:
+                # in the order they're stored in, so the old segments are read front to back
+                for name, entry in sorted(self.entries.items(),key=lambda item: item[1]):
+                    if entry[0] not in files:
+                        files[entry[0]] = open(self._make_segment_path(entry[0]),'rb')
+                    entries[name] = self._append(self._read_data(files[entry[0]],entry))
+            finally:
+                for f in files.values():
+                    f.close()
+                self._close_writers()
+            temp_path = self._make_path(self.index_file + '.tmp')
+            with open(temp_path,'w') as f:
+                for name in sorted(entries):
+                    f.write(self._format_entry(name,entries[name]))
+            os.rename(temp_path,self._make_path(self.index_file))
+            self.entries = entries
+            for segment in old_segments:
+                os.remove(self._make_segment_path(segment))
+
+
+PAGE_STORES = {'directory': DirectoryPageStore,
+               'packed': PackedPageStore}
+
+
+def copy_pages(source,destination):
+    # copy every page from one page store to another, e.g. to pack a directory of pages
+    for name, page in source.iter_pages():
+        destination.write(name,page)
+    destination.close()
 
 
 class Downloader:
@@ -31,18 +664,45 @@ class Downloader:
     1) Files containing hyperlinks to player profiles
         Downloading these files allows us to gather an exhaustive list of the players in the database,
         as well as hyperlinks to each of their profiles.
-        METHOD: download_player_listings(self,delay=5,monitor=False)
+        METHOD: download_player_listings(self,delay=5,monitor=False,workers=8,retries=3,backoff=2)
 
     2) Player profiles
         The player profiles contain the personal info, performance stats, and game records of the
         individual players.
-        METHOD: download_player_profiles(self,delay=5,monitor=False)
+        METHOD: download_player_profiles(self,delay=5,monitor=False,workers=1,retries=3,backoff=2,max_age=None,
+                                         shard=0,num_shards=1,player_index=None)
+        Each profile is downloaded once, however many position listings the player appears in (see
+        PlayerIndex).
+
+    Requests are paced by a RateLimiter allowing one request every 'delay' seconds across all workers,
+    so raising 'workers' only helps when the server takes longer than 'delay' to respond.
+    Transient failures (URLError, 5xx responses) are retried 'retries' times, waiting backoff, 2*backoff,
+    4*backoff... seconds between attempts, before being written to the error log.
+
+    Every fetch is recorded in a Manifest. Pages that are already on disk are requested conditionally
+    (If-None-Match/If-Modified-Since) and left alone when the server answers 304 Not Modified. Passing
+    max_age (seconds) skips the urls fetched successfully within that time, which is how an interrupted
+    crawl resumes instead of starting over.
+
+    With num_shards > 1, only the profiles in the given shard are downloaded (see shard_for and
+    ShardedCrawl).
+
+    The pages are saved in page stores (see PAGE_STORES): 'directory' saves a file per page, 'packed'
+    packs them into a few compressed segment files.
     """
-    def __init__(self):
+    def __init__(self,page_store='directory'):
         self.base_url = 'http://fftoday.com'
         self.player_listings_dir = PLAYER_LISTINGS_DIR
         self.player_profiles_dir = PLAYER_PROFILES_DIR
+        self.page_store = page_store
+        self._page_stores = {}
+        self._page_stores_lock = threading.Lock()
         self.error_log_file = 'error_log.txt'
+        self.rate_limiter = None
+        self.metrics = METRICS
+        self.session = HTTPSession()
+        self.manifest = Manifest(DOWNLOAD_MANIFEST_FILE)
+        self._error_log_lock = threading.Lock()
         self._make_directories()
 
     def _make_directories(self):
@@ -52,8 +712,7 @@ class Downloader:
 
     def _make_request(self,url):
         headers = { 'User-Agent' : 'Mozilla/4.0 (compatible; MSIE 5.5; Windows NT)' }
-        data = ''
-        return urllib2.Request(url, data, headers)
+        return urllib2.Request(url, None, headers) # no data, so this is a GET
 
     def _make_player_listing_url(self,position):
         return self.base_url + '/stats/players?Pos=' + position
@@ -62,69 +721,783 @@ class Downloader:
         return time.strftime('%Y-%m-%d %H:%M:%S') + '\t' + str(exception.reason) + '\t' + url + '\n'
 
     def _log_error(self,url,e):
-        with open(self.error_log_file,'a') as f:
-            error_string = self._make_error_string(url,e)
-            f.write(error_string)
+        with self._error_log_lock:
+            with open(self.error_log_file,'a') as f:
+                error_string = self._make_error_string(url,e)
+                f.write(error_string)
+
+    def _set_rate_limit(self,delay):
+        # one request every 'delay' seconds, shared by all threads.
+        if delay > 0:
+            self.rate_limiter = RateLimiter(1.0/delay)
+        else:
+            self.rate_limiter = None
 
-    def _save_page(self,page,url,directory):
-        output_file = url.replace('/','_') + '.html'
-        output_path = os.path.join(directory,output_file)
-        with open(output_path,'w') as f:
-            f.write(page)
+    def _is_transient(self,exception):
+        # server errors and network failures are worth another try. 4xx responses are not.
+        if isinstance(exception,urllib2.HTTPError):
+            return exception.code >= 500
+        return True
+
+    def _make_output_file(self,url):
+        return url.replace('/','_') + '.html'
 
-    def _download(self, request,destination_directory):
+    def _get_page_store(self,directory):
+        with self._page_stores_lock:
+            if directory not in self._page_stores:
+                self._page_stores[directory] = PAGE_STORES[self.page_store](directory)
+            return self._page_stores[directory]
+
+    def _close_page_stores(self):
+        with self._page_stores_lock:
+            for page_store in self._page_stores.values():
+                page_store.close()
+            self._page_stores = {}
+
+    def _save_page(self,page,url,directory):
+        self._get_page_store(directory).write(self._make_output_file(url),page)
+
+    def _add_conditional_headers(self,request,entry):
+        if entry.get('etag'):
+            request.add_header('If-None-Match',entry['etag'])
+        if entry.get('last_modified'):
+            request.add_header('If-Modified-Since',entry['last_modified'])
+
+    def _record_page(self,page,url,response,entry,destination_directory):
+        # save the page if its content changed, and record the fetch in the manifest.
+        now = time.time()
+        content_hash = hashlib.sha1(page).hexdigest()
+        output_file = self._make_output_file(url)
+        exists = self._get_page_store(destination_directory).exists(output_file)
+        changed = entry is None or entry.get('hash') != content_hash or not exists
+        if changed:
+            self._save_page(page,url,destination_directory)
+        headers = response.info()
+        self.manifest.record(url,
+                             file=output_file,
+                             status=response.getcode(),
+                             etag=headers.getheader('ETag'),
+                             last_modified=headers.getheader('Last-Modified'),
+                             hash=content_hash,
+                             fetched=now,
+                             changed=now if changed else entry['changed'])
+
+    def _read_saved_page(self,url,destination_directory):
+        return self._get_page_store(destination_directory).read(self._make_output_file(url))
+
+    def _download(self, request,destination_directory,retries=0,backoff=2,return_page=False):
+        # returns whether the download succeeded. With return_page, returns the page instead (read
+        # back from the page store if it wasn't modified), or None if the download failed.
         url = request.get_full_url()
+        entry = self.manifest.get(url)
+        if entry and self._get_page_store(destination_directory).exists(self._make_output_file(url)):
+            self._add_conditional_headers(request,entry)
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            start = time.time()
+            try:
+                response = self.session.open(request)
+                page = response.read()
+            except urllib2.URLError as e: # HTTPError is a subclass of URLError
+                self.metrics.record('download','error',time.time() - start,label=url)
+                if attempt < retries and self._is_transient(e):
+                    time.sleep(backoff * 2**attempt)
+                    attempt += 1
+                    continue
+                self._log_error(url,e)
+                self.manifest.record(url,status=getattr(e,'code','error'),fetched=time.time())
+                return None if return_page else False
+            else:
+                self.metrics.record('download','fetch',time.time() - start,len(page),label=url)
+                if response.getcode() == 304:
+                    self.manifest.record(url,status=304,fetched=time.time())
+                    return self._read_saved_page(url,destination_directory) if return_page else True
+                self._record_page(page,url,response,entry,destination_directory)
+                return page if return_page else True
+
+    def _download_page(self,url,destination_directory,monitor,retries,backoff):
+        self._download(self._make_request(url),destination_directory,retries,backoff)
+        if monitor:
+            print url
+
+    def _download_pages(self,urls,destination_directory,monitor,workers,retries,backoff):
+        if workers <= 1:
+            for url in urls:
+                self._download_page(url,destination_directory,monitor,retries,backoff)
+            return
+        def download(url):
+            self._download_page(url,destination_directory,monitor,retries,backoff)
+        pool = ThreadPool(workers)
         try:
-            response = urllib2.urlopen(request)
-        except urllib2.HTTPError as e:
-            self._log_error(url,e)
-        except urllib2.URLError as e:
-            self._log_error(url,e)
-        else:
-            page = response.read()
-            self._save_page(page,url,destination_directory)
-
+            # iterating the results re-raises any unexpected exception from the workers.
+            for _ in pool.imap_unordered(download,urls):
+                pass
+        finally:
+            pool.terminate()
 
-    def download_player_listings(self,delay=5,monitor=False):
+    def download_player_listings(self,delay=5,monitor=False,workers=8,retries=3,backoff=2):
         # Download the pages that list the player's names, and hyperlinks to their profiles.
-        # The player listing pages are by position.
+        # The player listing pages are by position. There are only eight, so they're all fetched at
+        # once (still paced by the rate limiter).
+        self._set_rate_limit(delay)
         positions = ['QB','RB','WR','TE','K','DL','LB','DB']
-        for position in positions:
-            url = self._make_player_listing_url(position)
-            request = self._make_request(url)
-            self._download(request,self.player_listings_dir)
-            if monitor:
-                print url
-            time.sleep(delay)
-
-    def download_player_profiles(self,delay=5,monitor=False):
-        scraper = Scraper()
-        names_and_urls = scraper.scrape_player_listings()
-        for record in names_and_urls:
-            url = self.base_url + record[1]
-            request = self._make_request(url)
-            self._download(request,self.player_profiles_dir)
-            if monitor:
-                print url
-            time.sleep(delay)
+        urls = [self._make_player_listing_url(position) for position in positions]
+        self._download_pages(urls,self.player_listings_dir,monitor,workers,retries,backoff)
+        self._close_page_stores()
+        self.manifest.compact()
+
+    def download_player_profiles(self,delay=5,monitor=False,workers=1,retries=3,backoff=2,max_age=None,
+                                 shard=0,num_shards=1,player_index=None):
+        # player_index is a PlayerIndex of the listings. By default it's made from the saved listings.
+        self._set_rate_limit(delay)
+        if player_index is None:
+            player_index = Scraper(page_store=self.page_store).index_player_listings()
+        hrefs = player_index.hrefs()
+        if num_shards > 1:
+            hrefs = [href for href in hrefs if shard_for(href,num_shards) == shard]
+        urls = [self.base_url + href for href in hrefs]
+        if max_age is not None:
+            # resume: skip what was fetched recently.
+            urls = [url for url in urls if not self.manifest.is_fresh(url,max_age)]
+        self._download_pages(urls,self.player_profiles_dir,monitor,workers,retries,backoff)
+        self._close_page_stores()
+        self.manifest.compact()
+
+class SoupEngine:
+    """
+    The Scraper reads parsed pages through an engine, so that the parser can be swapped without
+    touching the scraping logic. This is the original one: a full BeautifulSoup tree with the lxml
+    backend. Passing a SoupStrainer as parse_only builds only the matching parts of the tree.
+    """
+    def __init__(self,parse_only=None):
+        self.parse_only = parse_only
+
+    def parse(self,page):
+        return BeautifulSoup(page,"lxml",parse_only=self.parse_only)
+
+    def find_all(self,element,tag):
+        return element.find_all(tag)
+
+    def find(self,element,tag):
+        return element.find(tag)
+
+    def find_parent(self,element,tag):
+        return element.find_parent(tag)
+
+    def text(self,element):
+        return element.text
+
+    def get(self,element,attribute):
+        return element.get(attribute)
+
+    def title(self,document):
+        return document.title.text
+
+    def markup(self,element):
+        return unicode(element)
+
+
+class LxmlEngine:
+    """
+    Works on lxml's own tree with XPath, skipping the BeautifulSoup tree altogether. It's several times
+    faster and lighter than SoupEngine, and gives the same answers: text() skips the contents of
+    script/style/template tags the way BeautifulSoup's .text does, and markup() serializes an element
+    the way BeautifulSoup does.
+    """
+    # the tags BeautifulSoup writes as <tag/>
+    empty_element_tags = set(['area','base','br','col','embed','hr','img','input','keygen','link',
+                              'menuitem','meta','param','source','track','wbr','basefont','bgsound',
+                              'command','frame','image','isindex','nextid','spacer'])
+    # the tags whose contents BeautifulSoup writes without escaping
+    cdata_containing_tags = set(['script','style'])
+    text_nodes = etree.XPath('.//text()[not(ancestor::script or ancestor::style or ancestor::template)]')
+
+    def parse(self,page):
+        if isinstance(page,str):
+            # decode the same way BeautifulSoup would
+            page = UnicodeDammit(page,is_html=True).unicode_markup
+        return lxml.html.document_fromstring(page)
+
+    def find_all(self,element,tag):
+        return list(element.iterdescendants(tag))
+
+    def find(self,element,tag):
+        return next(element.iterdescendants(tag),None)
+
+    def find_parent(self,element,tag):
+        return next(element.iterancestors(tag),None)
+
+    def text(self,element):
+        return unicode(''.join(self.text_nodes(element)))
+
+    def get(self,element,attribute):
+        value = element.get(attribute)
+        return unicode(value) if value is not None else None
+
+    def title(self,document):
+        return self.text(document.find('.//title'))
+
+    def _escape(self,string):
+        return string.replace('&','&amp;').replace('<','&lt;').replace('>','&gt;')
+
+    def _quote(self,value):
+        value = self._escape(value)
+        if '"' in value:
+            if "'" in value:
+                return '"' + value.replace('"','&quot;') + '"'
+            return "'" + value + "'"
+        return '"' + value + '"'
+
+    def _markup(self,element,parts):
+        if not isinstance(element.tag,basestring):
+            # comments, processing instructions
+            if isinstance(element,etree._Comment):
+                parts.append(u'<!--' + (element.text or u'') + u'-->')
+        else:
+            attributes = ''.join([' %s=%s' % (name,self._quote(value)) for name, value in element.items()])
+            if element.tag in self.empty_element_tags and element.text is None and len(element) == 0:
+                parts.append(u'<%s%s/>' % (element.tag,attributes))
+            else:
+                parts.append(u'<%s%s>' % (element.tag,attributes))
+                if element.text:
+                    if element.tag in self.cdata_containing_tags:
+                        parts.append(element.text)
+                    else:
+                        parts.append(self._escape(element.text))
+                for child in element:
+                    self._markup(child,parts)
+                parts.append(u'</%s>' % element.tag)
+        if element.tail:
+            parts.append(self._escape(element.tail))
+
+    def markup(self,element):
+        parts = []
+        self._markup(element,parts)
+        if element.tail:
+            parts.pop() # the element's own tail isn't part of it
+        return u''.join(parts)
+
+
+ENGINES = {'soup': SoupEngine(),
+           'strainer': SoupEngine(parse_only=SoupStrainer(['title','table'])),
+           'lxml': LxmlEngine()}
+
+
+class TableIndex:
+    """
+    An index of the tables in a parsed page, built once per page: each table's position (in document
+    order), its text, its nesting depth, and the position of the last table nested inside it.
+
+    find_lowest(string) gives the same answer as Scraper.find_lowest_element_containing_string, but
+    it scans precomputed strings instead of calling find_all and .text again at every level, and it
+    remembers its answers.
+
+    gamelog_years() finds every 'YYYY Gamelog Stats' heading with one regular expression pass over the
+    tables' text, however many seasons there are, and find_gamelog_heading(year) then finds each
+    heading's table with set lookups instead of more substring searches.
+    """
+    def __init__(self,soup,engine=ENGINES['soup']):
+        self.tables = engine.find_all(soup,'table')
+        self.texts = [engine.text(table) for table in self.tables]
+        positions = dict((id(table),i) for i, table in enumerate(self.tables))
+        parents = []
+        for table in self.tables:
+            parent = engine.find_parent(table,'table')
+            parents.append(positions[id(parent)] if parent is not None else None)
+        # depth: the number of tables this table is nested in
+        self.depths = []
+        for parent in parents:
+            self.depths.append(0 if parent is None else self.depths[parent] + 1)
+        # the tables nested in table i are the ones at positions i+1 ... ends[i]
+        self.ends = range(len(self.tables))
+        for i in reversed(range(len(self.tables))):
+            if parents[i] is not None:
+                self.ends[parents[i]] = max(self.ends[parents[i]],self.ends[i])
+        self.lowest = {} # string -> position of the lowest table containing it
+        self.gamelog_headings = None # for each table, the years of the gamelog headings in its text
+        self.lowest_gamelog_headings = {} # year -> position of the lowest table containing its heading
+
+    def _find_lowest(self,contains):
+        # take the first table for which contains(position) is true. While it has nested tables, move
+        # on to the first of those for which it's true.
+        start, stop = 0, len(self.tables)
+        while True:
+            for i in xrange(start,stop):
+                if contains(i):
+                    break
+            else:
+                return None
+            if self.ends[i] == i:
+                return i
+            start, stop = i + 1, self.ends[i] + 1
+
+    def find_lowest(self,string):
+        # the position of the lowest table containing the string, or None.
+        if string not in self.lowest:
+            self.lowest[string] = self._find_lowest(lambda i: string in self.texts[i])
+        return self.lowest[string]
+
+    def _find_gamelog_headings(self):
+        if self.gamelog_headings is None:
+            self.gamelog_headings = [set(GAMELOG_PATTERN.findall(text)) for text in self.texts]
+        return self.gamelog_headings
+
+    def gamelog_years(self):
+        # the years with a gamelog heading in a table, oldest first
+        return sorted(set().union(*self._find_gamelog_headings()))
+
+    def find_gamelog_heading(self,year):
+        # the same as find_lowest(year + ' Gamelog Stats')
+        if year not in self.lowest_gamelog_headings:
+            headings = self._find_gamelog_headings()
+            self.lowest_gamelog_headings[year] = self._find_lowest(lambda i: year in headings[i])
+        return self.lowest_gamelog_headings[year]
+
+
+def _intern_text(string):
+    # the one shared copy of an ASCII string, as a str. Other text is returned as it is.
+    try:
+        return intern(string.encode('ascii'))
+    except UnicodeError:
+        return string
+
+
+class PlayerRecord(object):
+    """
+    One row of the player info file. The fields are slots instead of dict keys, so a record is a
+    handful of pointers rather than a hash table, but it reads and writes like the dict it replaced:
+    record['age'] = ... Unknown fields are an AttributeError instead of a new column.
+
+    'fields' is the column order of the player info file.
+    """
+    # the order the dict version of the record came out in, so the files stay the same
+    fields = ('current_team','last_name','weight','DOB','height','current_position','college','id',
+              'first_name','age','draft')
+    __slots__ = fields
+
+    def __init__(self,player_id,null_character='\N'):
+        for field in self.fields:
+            setattr(self,field,null_character)
+        self.id = unicode(player_id)
+
+    def __getitem__(self,field):
+        return getattr(self,field)
+
+    def __setitem__(self,field,value):
+        setattr(self,field,value)
+
+    def keys(self):
+        return list(self.fields)
+
+    def values(self):
+        return [getattr(self,field) for field in self.fields]
+
+    def __getstate__(self):
+        return self.values()
+
+    def __setstate__(self,state):
+        for field, value in zip(self.fields,state):
+            setattr(self,field,value)
+
+
+class StatRows(object):
+    """
+    The records scraped from stats tables, kept a table row at a time instead of as one list per
+    stat value. Each row stores its leading columns (player id, season, team...) once, a reference
+    to its table's tuple of stat types, and a tuple of its values.
+
+    The strings are interned: ASCII text (nearly all of it) is stored as an interned str, so a team,
+    a season or a '0' exists once however many rows mention it, and costs a pointer per mention.
+    Interned strings are freed with the last record that uses them. Text that isn't ASCII is kept
+    as it is.
+
+    Iterating yields the same records as the lists did, one tuple per stat value:
+
+    (player_id, <leading columns>, stat_type, stat_value)
+    """
+    __slots__ = ('row_keys','row_stat_types','row_values')
+
+    def __init__(self):
+        self.row_keys = []
+        self.row_stat_types = []
+        self.row_values = []
+
+    def add_row(self,keys,stat_types,values):
+        self.row_keys.append(tuple(map(_intern_text,keys)))
+        self.row_stat_types.append(stat_types)
+        self.row_values.append(tuple(map(_intern_text,values)))
+
+    def extend(self,other):
+        for keys, stat_types, values in itertools.izip(other.row_keys,other.row_stat_types,other.row_values):
+            self.add_row(keys,stat_types,values)
+
+    def __iadd__(self,other):
+        self.extend(other)
+        return self
+
+    def map(self,function):
+        # new rows with function(string) in place of every string. function is called once per
+        # distinct string.
+        mapped = {}
+        def convert(string):
+            if string not in mapped:
+                mapped[string] = function(string)
+            return mapped[string]
+        mapped_stat_types = {}
+        rows = StatRows()
+        for keys, stat_types, values in itertools.izip(self.row_keys,self.row_stat_types,self.row_values):
+            if stat_types not in mapped_stat_types:
+                mapped_stat_types[stat_types] = tuple(map(_intern_text,map(convert,stat_types)))
+            rows.add_row(map(convert,keys),mapped_stat_types[stat_types],map(convert,values))
+        return rows
+
+    def __iter__(self):
+        for keys, stat_types, values in itertools.izip(self.row_keys,self.row_stat_types,self.row_values):
+            for stat_type, stat_value in itertools.izip(stat_types,values):
+                yield keys + (stat_type,stat_value)
+
+    def __len__(self):
+        return sum(map(len,self.row_values))
+
+    def __nonzero__(self):
+        return len(self.row_values) > 0
+
+    def __getstate__(self):
+        return self.row_keys, self.row_stat_types, self.row_values
+
+    def __setstate__(self,state):
+        # pickle keeps the shared strings and stat types shared
+        self.row_keys, self.row_stat_types, self.row_values = state
+
+
+class RecordWriter:
+    """
+    Appends tab-separated records to a file as they're produced. Writes go through a large buffer,
+    which is flushed to disk every 'flush_every' records, so a crash loses little work and nothing
+    accumulates in memory.
+    """
+    def __init__(self,path,buffer_size=1<<20,flush_every=10000):
+        self.file = open(path,'a',buffer_size)
+        self.flush_every = flush_every
+        self.unflushed = 0
+
+    def write(self,record):
+        self.write_all([record])
+
+    def write_all(self,records):
+        if not records:
+            return
+        output_string = ''.join(['\t'.join(record)+'\n' for record in records])
+        self.file.write(output_string.encode('utf-8'))
+        self.unflushed += len(records)
+        if self.unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        self.unflushed = 0
+
+    def close(self):
+        self.file.close()
+
+
+class FlatFileStore:
+    """
+    Streams a Scraper's records into its three flat files (player info, season stats, gamelog stats)
+    one profile at a time.
+    """
+    def __init__(self,scraper,flush_every=10000):
+        directory = scraper.scraped_player_info_dir
+        self.player_fields = scraper._get_player_fields()
+        self.players = RecordWriter(os.path.join(directory,scraper.scraped_player_info_file),flush_every=flush_every)
+        self.season_stats = RecordWriter(os.path.join(directory,scraper.scraped_season_stats_file),flush_every=flush_every)
+        self.gamelog_stats = RecordWriter(os.path.join(directory,scraper.scraped_gamelog_stats_file),flush_every=flush_every)
+
+    def write_player(self,player_record):
+        self.players.write([player_record[field] for field in self.player_fields])
+
+    def write_season_stats(self,season_stats):
+        self.season_stats.write_all(season_stats)
+
+    def write_gamelog_stats(self,gamelog_stats):
+        self.gamelog_stats.write_all(gamelog_stats)
+
+    def close(self):
+        for writer in [self.players,self.season_stats,self.gamelog_stats]:
+            writer.close()
+
+
+class ParseCache:
+    """
+    An on-disk cache of the records scraped from each profile. Entries are keyed by a hash of the
+    page content, the player id and PARSER_VERSION, so a profile is only parsed again when its file
+    changes or the Scraper does. Each entry is a zlib-compressed pickle in its own file. evict() trims
+    the cache to max_bytes, dropping the least recently used entries first.
+    """
+    def __init__(self,directory=PARSE_CACHE_DIR,max_bytes=512*1024*1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.exists(self.directory):
+            try:
+                os.mkdir(self.directory)
+            except OSError: # another process got there first
+                pass
+
+    def make_key(self,page,player_id):
+        return hashlib.sha1('%s\t%s\t' % (PARSER_VERSION,player_id) + page).hexdigest()
+
+    def _make_path(self,key):
+        return os.path.join(self.directory,key + '.pkl.z')
+
+    def get(self,key):
+        # the cached records, or None
+        path = self._make_path(key)
+        try:
+            with open(path,'rb') as f:
+                data = f.read()
+            os.utime(path,None) # mark it as recently used
+        except (IOError,OSError):
+            return None
+        return cPickle.loads(zlib.decompress(data))
+
+    def put(self,key,records):
+        path = self._make_path(key)
+        temp_path = '%s.%d.tmp' % (path,os.getpid())
+        with open(temp_path,'wb') as f:
+            f.write(zlib.compress(cPickle.dumps(records,cPickle.HIGHEST_PROTOCOL)))
+        os.rename(temp_path,path) # readers never see half an entry
+
+    def evict(self):
+        entries = []
+        for file in os.listdir(self.directory):
+            path = os.path.join(self.directory,file)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime,stat.st_size,path))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class SQLiteStore:
+    """
+    Writes a Scraper's records straight into a SQLite database (SCRAPED_DATABASE_FILE, in the scraped
+    player info directory) instead of flat files. It has the same methods as FlatFileStore.
+
+    Values are typed on the way in, with the Cleaner's rules: numbers become INTEGER/REAL, '\N' and
+    empty values become NULL, and text is stripped. Rows are inserted 'batch_size' at a time with
+    executemany, one transaction per batch. The indexes are built at the end, which is much faster
+    than maintaining them during the load.
+    """
+    schema = [
+        """CREATE TABLE players (
+            id INTEGER PRIMARY KEY,
+            first_name TEXT,
+            last_name TEXT,
+            current_position TEXT,
+            current_team TEXT,
+            DOB TEXT,
+            age INTEGER,
+            height INTEGER,
+            weight INTEGER,
+            draft TEXT,
+            college TEXT)""",
+        """CREATE TABLE season_stats (
+            player_id INTEGER NOT NULL,
+            season INTEGER,
+            team TEXT,
+            stat_type TEXT,
+            stat_value REAL)""",
+        """CREATE TABLE gamelog_stats (
+            player_id INTEGER NOT NULL,
+            season INTEGER,
+            week INTEGER,
+            result TEXT,
+            opponent TEXT,
+            stat_type TEXT,
+            stat_value REAL)"""]
+    indexes = [
+        "CREATE INDEX IF NOT EXISTS season_stats_by_player ON season_stats (player_id, season)",
+        "CREATE INDEX IF NOT EXISTS season_stats_by_type ON season_stats (stat_type, season)",
+        "CREATE INDEX IF NOT EXISTS season_stats_by_season ON season_stats (season)",
+        "CREATE INDEX IF NOT EXISTS gamelog_stats_by_player ON gamelog_stats (player_id, season, week)",
+        "CREATE INDEX IF NOT EXISTS gamelog_stats_by_type ON gamelog_stats (stat_type, season, week)",
+        "CREATE INDEX IF NOT EXISTS gamelog_stats_by_season ON gamelog_stats (season, week)",
+        "CREATE INDEX IF NOT EXISTS gamelog_stats_by_week ON gamelog_stats (week)"]
+    player_columns = ['id','first_name','last_name','current_position','current_team','DOB','age',
+                      'height','weight','draft','college']
+    numerical_player_columns = set(['id','age','height','weight'])
+
+    def __init__(self,scraper,batch_size=10000):
+        self.path = os.path.join(scraper.scraped_player_info_dir,scraper.scraped_database_file)
+        self.batch_size = batch_size
+        self.cleaner = Cleaner()
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        # start from scratch, like the flat files do
+        with self.connection:
+            for table in ['players','season_stats','gamelog_stats']:
+                self.connection.execute('DROP TABLE IF EXISTS ' + table)
+            for statement in self.schema:
+                self.connection.execute(statement)
+        self.players = []
+        self.season_stats = []
+        self.gamelog_stats = []
+
+    def _text(self,value):
+        value = value.strip()
+        if value == '' or value == self.cleaner.null_character:
+            return None
+        return value
+
+    def _number(self,value):
+        value = self.cleaner.clean_value(value.strip())
+        if value == self.cleaner.null_character:
+            return None
+        return value
+
+    def write_player(self,player_record):
+        row = []
+        for column in self.player_columns:
+            if column in self.numerical_player_columns:
+                row.append(self._number(player_record[column]))
+            else:
+                row.append(self._text(player_record[column]))
+        self.players.append(row)
+        if len(self.players) >= self.batch_size:
+            self.flush()
+
+    def write_season_stats(self,season_stats):
+        for player_id, season, team, stat_type, stat_value in season_stats:
+            self.season_stats.append((int(player_id),self._number(season),self._text(team),
+                                      self._text(stat_type),self._number(stat_value)))
+        if len(self.season_stats) >= self.batch_size:
+            self.flush()
+
+    def write_gamelog_stats(self,gamelog_stats):
+        for player_id, season, week, result, opponent, stat_type, stat_value in gamelog_stats:
+            self.gamelog_stats.append((int(player_id),self._number(season),self._number(week),self._text(result),
+                                       self._text(opponent),self._text(stat_type),self._number(stat_value)))
+        if len(self.gamelog_stats) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        with self.connection: # one transaction
+            self.connection.executemany('INSERT OR REPLACE INTO players VALUES (?,?,?,?,?,?,?,?,?,?,?)',self.players)
+            self.connection.executemany('INSERT INTO season_stats VALUES (?,?,?,?,?)',self.season_stats)
+            self.connection.executemany('INSERT INTO gamelog_stats VALUES (?,?,?,?,?,?,?)',self.gamelog_stats)
+        self.players = []
+        self.season_stats = []
+        self.gamelog_stats = []
+
+    def close(self):
+        self.flush()
+        with self.connection:
+            for statement in self.indexes:
+                self.connection.execute(statement)
+        self.connection.execute('ANALYZE')
+        self.connection.close()
+
+
+STORES = {'flat': FlatFileStore,
+          'sqlite': SQLiteStore}
+
+
+class PlayerIndex:
+    """
+    The players in the position listings, one entry per profile href. A player listed under more
+    than one position has one entry, with all of the positions, so their profile is only fetched
+    and scraped once.
+    """
+    def __init__(self):
+        self.players = {} # href -> [name, set of positions]
+
+    def add(self,name,href,position):
+        if href in self.players:
+            self.players[href][1].add(position)
+        else:
+            self.players[href] = [name,set([position])]
+
+    def add_records(self,records):
+        # records as made by Scraper.scrape_player_listings: [name, href, position]
+        for name, href, position in records:
+            self.add(name,href,position)
+
+    def hrefs(self):
+        return sorted(self.players)
+
+    def name(self,href):
+        return self.players[href][0]
+
+    def positions(self,href):
+        return sorted(self.players[href][1])
+
+    def __len__(self):
+        return len(self.players)
+
+    def __contains__(self,href):
+        return href in self.players
+
+    def __iter__(self):
+        return iter(self.hrefs())
+
+
+def _scrape_player_listing(task):
+    # module-level, so that multiprocessing can pickle it
+    file, page, engine = task
+    return Scraper(engine)._scrape_player_listing_page(file,page)
+
+
+def _scrape_player_page(task):
+    # module-level, so that multiprocessing can pickle it. The metrics go back with the records.
+    page, player_id, engine, cache_dir = task
+    cache = ParseCache(cache_dir) if cache_dir else None
+    scraper = Scraper(engine)
+    scraper.metrics = Metrics(keep_events=True)
+    return scraper.scrape_player_page(page,player_id,cache), scraper.metrics.events
+
 
 class Scraper:
     """
-    The scrape_player_profiles method parses the html files in the directories found in these variables:
+    The scrape_player_profiles method parses the html files in the page stores (see PAGE_STORES)
+    found in these variables:
 
     self.player_listings_dir
     self.player_profiles_dir
 
-    ...and then prints the data to flat files.
+    ...and then writes the data to a store (see STORES): flat files, or a SQLite database.
     That's pretty much it.
+
+    The engine picks the parser (see ENGINES); they all produce the same records. scrape_player_profiles
+    can spread the parsing over a pool of processes and reuse cached records (see ParseCache), and
+    writes each profile's records (a PlayerRecord and two StatRows) as soon as they're parsed. The
+    output is in file name order either way.
     """
-    def __init__(self):
+    def __init__(self,engine='soup',page_store='directory'):
+        self.engine_name = engine
+        self.engine = ENGINES[engine]
+        self.page_store = page_store
+        self.metrics = METRICS
         self.player_listings_dir = PLAYER_LISTINGS_DIR
         self.player_profiles_dir = PLAYER_PROFILES_DIR
         self.scraped_player_info_dir = SCRAPED_PLAYER_INFO
         self.scraped_player_info_file = SCRAPED_PLAYER_INFO_FILE
         self.scraped_season_stats_file = SCRAPED_SEASON_STATS_FILE
         self.scraped_gamelog_stats_file = SCRAPED_GAMELOG_STATS_FILE
+        self.scraped_database_file = SCRAPED_DATABASE_FILE
+        self.parse_cache_dir = PARSE_CACHE_DIR
+        self.parse_cache_max_bytes = 512*1024*1024
 
     def _check_if_player_listings_dir_exists(self):
         if not os.path.exists(self.player_listings_dir):
@@ -145,19 +1518,29 @@ class Scraper:
             f = open(path,'w')
             f.close()
 
+    def _get_page_store(self,directory):
+        return PAGE_STORES[self.page_store](directory)
+
     def _extract_name(self,string):
         string = string.replace(',','')
         parts = string.split(' ')
         return parts[1] + ' ' + parts[0]
 
     def _parse_player_listings(self,page):
-        soup = BeautifulSoup(page,"lxml")
-        tables = soup.find_all('table')
+        soup = self.engine.parse(page)
+        tables = self.engine.find_all(soup,'table')
         table = tables[7] # the goods are in table 7
-        a_tags = table.find_all('a')
-        records = [[self._extract_name(a.text), a['href']] for a in a_tags]
+        a_tags = self.engine.find_all(table,'a')
+        records = [[self._extract_name(self.engine.text(a)), self.engine.get(a,'href')] for a in a_tags]
         return records
 
+    def changed_profile_files(self,since):
+        # The profile files whose content changed at or after 'since' (seconds since the epoch),
+        # according to the Downloader's manifest.
+        manifest = Manifest(DOWNLOAD_MANIFEST_FILE)
+        files = set(self._get_page_store(self.player_profiles_dir).names())
+        return sorted(file for file in manifest.changed_since(since) if file in files)
+
     def _get_position_from_string(self,string):
         # get the football position from the filename/url
         string = string.replace('.html','')
@@ -167,20 +1550,42 @@ class Scraper:
     def _add_position(self,records,position):
         return [record + [position] for record in records]
 
-    def scrape_player_listings(self):
+    def _scrape_player_listing_page(self,file,page):
+        position = self._get_position_from_string(file)
+        records = self._parse_player_listings(page)
+        return self._add_position(records,position)
+
+    def _iter_player_listings(self,processes=1):
+        # the records of each listing page, parsed in a pool of 'processes' processes
         self._check_if_player_listings_dir_exists()
-        files = os.listdir(self.player_listings_dir)
+        page_store = self._get_page_store(self.player_listings_dir)
+        if processes <= 1:
+            for file, page in page_store.iter_pages():
+                yield self._scrape_player_listing_page(file,page)
+            return
+        pool = multiprocessing.Pool(processes)
+        try:
+            tasks = ((file,page,self.engine_name) for file, page in page_store.iter_pages())
+            for records in pool.imap(_scrape_player_listing,tasks):
+                yield records
+        finally:
+            pool.terminate()
+
+    def scrape_player_listings(self,processes=1):
+        # [name, href, position] for each link in the listings. A player listed under more than one
+        # position appears once for each.
         player_listings = []
-        for file in files:
-            position = self._get_position_from_string(file)
-            path = os.path.join(self.player_listings_dir,file)
-            with open(path,'r') as f:
-                page = f.read()
-            records = self._parse_player_listings(page)
-            records = self._add_position(records,position)
+        for records in self._iter_player_listings(processes):
             player_listings += records
         return player_listings
 
+    def index_player_listings(self,processes=1):
+        # the players in the listings as a PlayerIndex, with each profile once
+        player_index = PlayerIndex()
+        for records in self._iter_player_listings(processes):
+            player_index.add_records(records)
+        return player_index
+
     def parse_height(self,height):
         # split up the unicode characters
         parts = list(height)
@@ -209,23 +1614,19 @@ class Scraper:
         else:
             raise Exception("there's something wrong with this height:%s",height)
 
-    def scrape_player_information(self,soup,player_id):
+    def _make_player_record(self,player_id):
         # '\N' is the null-character for MySQL
-        null_character = '\N'
-        player_record = {'first_name':null_character,
-                         'last_name':null_character,
-                         'current_position':null_character,
-                         'current_team':null_character,
-                         'DOB':null_character,
-                         'age':null_character,
-                         'height':null_character,
-                         'weight':null_character,
-                         'draft':null_character,
-                         'college':null_character,
-                         'id':unicode(player_id)}
+        return PlayerRecord(player_id,'\N')
+
+    def _get_player_fields(self):
+        # the column order of the player info file
+        return list(PlayerRecord.fields)
+
+    def scrape_player_information(self,soup,player_id):
+        player_record = self._make_player_record(player_id)
         # some player info comes from in the title tag
         try:
-            position_name_team = soup.title.text.replace('- FF Today','') # position/name/team
+            position_name_team = self.engine.title(soup).replace('- FF Today','') # position/name/team
             parts = position_name_team.split(' ')
             player_record['current_position'] = parts[0]
             player_record['first_name'] = parts[1]
@@ -237,8 +1638,8 @@ class Scraper:
         else:
             pass
         # Other player info comes from a poorly structured table further down the page.
-        tables = soup.find_all('table')
-        player_info = unicode(tables[7].td)
+        tables = self.engine.find_all(soup,'table')
+        player_info = self.engine.markup(self.engine.find(tables[7],'td'))
         # get rid of some pesky html
         for each in ['<br/>','<td>','</td>','<td class="bodycontent"><strong>','</strong>','amp;']:
             player_info = player_info.replace(each,'')
@@ -264,10 +1665,10 @@ class Scraper:
 
     def find_lowest_element_containing_string(self,soup,element_type,string):
         # recursivly find the lowest table that contains the string.
-        elements = soup.find_all(element_type)
+        elements = self.engine.find_all(soup,element_type)
         for element in elements:
-            if string in element.text:
-                if len(element.find_all(element_type)) > 0:
+            if string in self.engine.text(element):
+                if len(self.engine.find_all(element,element_type)) > 0:
                     return self.find_lowest_element_containing_string(element,element_type,string)
                 else:
                     return element
@@ -275,146 +1676,192 @@ class Scraper:
 
     def merge_column_headers_with_super_column_headers(self,table):
         # get the header rows
-        rows = table.find_all('tr')
+        rows = self.engine.find_all(table,'tr')
         super_headers_row = rows[0]
         sub_headers_row = rows[1]
 
         # create super-header prefixes for the column names
-        super_header_tds = super_headers_row.find_all('td')
+        super_header_tds = self.engine.find_all(super_headers_row,'td')
         super_headers = []
         for td in super_header_tds:
             # get the column span of the super header
-            try:
-                n = int(td['colspan'])
-            except KeyError:
+            colspan = self.engine.get(td,'colspan')
+            if colspan is None:
                 n = 1
+            else:
+                n = int(colspan)
             # we only want some of the super headers
-            if td.text == 'Rushing':
+            text = self.engine.text(td)
+            if text == 'Rushing':
                 super_header = 'Rush_'
-            elif td.text == 'Receiving':
+            elif text == 'Receiving':
                 super_header = 'Rec_'
             else:
                 super_header = ''
 
             super_headers += [super_header for each in range(n)]
         # get the sub-headers
-        sub_headers = [td.text for td in sub_headers_row.find_all('td')]
+        sub_headers = [self.engine.text(td) for td in self.engine.find_all(sub_headers_row,'td')]
         # put them together
         headers = [''.join(z) for z in zip(super_headers,sub_headers)]
         return headers
 
-    def scrape_season_stats(self,soup,player_id):
+    def scrape_season_stats(self,soup,player_id,index=None):
         player_id = unicode(player_id)
+        if index is None:
+            index = TableIndex(soup,self.engine)
         # find the season stats table
         identifier_string = 'Team'
-        element_type = 'table'
-        table = self.find_lowest_element_containing_string(soup,element_type,identifier_string)
-        if table:
-            season_stat_records = []
-            rows = table.find_all('tr')
+        position = index.find_lowest(identifier_string)
+        if position is not None:
+            table = index.tables[position]
+            season_stat_records = StatRows()
+            rows = self.engine.find_all(table,'tr')
             # get the headers
             headers_row = rows[1]
-            tds = headers_row.find_all('td')
+            tds = self.engine.find_all(headers_row,'td')
             headers = self.merge_column_headers_with_super_column_headers(table)
+            stat_types = tuple(map(_intern_text,headers[2:])) # skip season and team
             # get the data
             for row in rows[2:]:
-                tds = row.find_all('td')
-                stat_season = tds[0].text
-                stat_team = tds[1].text
-                for i in range(2,len(headers)): # skip season and team
-                    stat_type = headers[i]
-                    stat_value = tds[i].text
-                    record = [player_id,stat_season,stat_team,stat_type,stat_value]
-                    season_stat_records.append(record)
+                tds = self.engine.find_all(row,'td')
+                stat_season = self.engine.text(tds[0])
+                stat_team = self.engine.text(tds[1])
+                stat_values = [self.engine.text(tds[i]) for i in range(2,len(headers))]
+                season_stat_records.add_row((player_id,stat_season,stat_team),stat_types,stat_values)
             return season_stat_records
+        return StatRows()
 
-    def scrape_gamelog_stats(self,soup,year,player_id):
+    def scrape_gamelog_stats(self,soup,year,player_id,index=None):
         player_id = unicode(player_id)
-        identifier_string = year + ' Gamelog Stats'
-        element_type = 'table'
+        if index is None:
+            index = TableIndex(soup,self.engine)
         # this line finds the table that directly preceeds the one we want
-        table = self.find_lowest_element_containing_string(soup,element_type,identifier_string)
-        tables = soup.find_all('table')
-        index = tables.index(table)
+        position = index.find_gamelog_heading(year)
         # the gamelog table...
-        gl_outer_table = tables[index + 1]
+        gl_outer_table = index.tables[position + 1]
         # for some reason they nested tables here...
-        gl_table = gl_outer_table.find_all('table')[0]
+        gl_table = self.engine.find_all(gl_outer_table,'table')[0]
 
-        gamelog_records = []
-        rows = gl_table.find_all('tr')
+        gamelog_records = StatRows()
+        rows = self.engine.find_all(gl_table,'tr')
         # get the headers
         headers = self.merge_column_headers_with_super_column_headers(gl_table)
+        stat_types = tuple(map(_intern_text,headers[3:])) # skip week, opponent and result
         # get the data
         for row in rows[2:]:
-            tds = row.find_all('td')
-            stat_week = tds[0].text
-            stat_opponent = tds[1].text
-            stat_result = tds[2].text
-            for i in range(3,len(headers)): # skip season and team
-                stat_type = headers[i]
-                stat_value = tds[i].text
-                record = [player_id,year,stat_week,stat_result,stat_opponent,stat_type,stat_value]
-                gamelog_records.append(record)
+            tds = self.engine.find_all(row,'td')
+            stat_week = self.engine.text(tds[0])
+            stat_opponent = self.engine.text(tds[1])
+            stat_result = self.engine.text(tds[2])
+            stat_values = [self.engine.text(tds[i]) for i in range(3,len(headers))]
+            gamelog_records.add_row((player_id,year,stat_week,stat_result,stat_opponent),stat_types,stat_values)
         return gamelog_records
 
 
-    def scrape_player_profiles(self):
+    def _make_player_id(self,file):
+        # Use fftoday's player number when the file name has one, and a checksum of the file name
+        # otherwise. Either way the id is the same from run to run.
+        match = PLAYER_ID_PATTERN.search(file)
+        if match:
+            return int(match.group(1))
+        return zlib.crc32(file) & 0xffffffff
+
+    def scrape_player_page(self,page,player_id,cache=None):
+        if cache is None:
+            return self._parse_player_page(page,player_id)
+        key = cache.make_key(page,player_id)
+        records = cache.get(key)
+        if records is None:
+            records = self._parse_player_page(page,player_id)
+            cache.put(key,records)
+        else:
+            self.metrics.record('scrape','cache_hit',0,label=player_id)
+        return records
+
+    def _parse_player_page(self,page,player_id):
+        size = len(page)
+        page = page.decode("utf8",errors='ignore')
+        # make the soup
+        start = time.time()
+        soup = self.engine.parse(page)
+        index = TableIndex(soup,self.engine)
+        self.metrics.record('scrape','parse',time.time() - start,size,label=player_id)
+        # scrape
+        with self.metrics.timer('scrape','scrape_player_information',player_id):
+            player_record = self.scrape_player_information(soup,player_id)
+        season_stats = StatRows()
+        if 'Season Stats' in page:
+            with self.metrics.timer('scrape','scrape_season_stats',player_id):
+                season_stats = self.scrape_season_stats(soup,player_id,index)
+        gamelog_stats = StatRows()
+        with self.metrics.timer('scrape','scrape_gamelog_stats',player_id):
+            for year in index.gamelog_years():
+                gamelog_stats += self.scrape_gamelog_stats(soup,year,player_id,index)
+        return player_record, season_stats, gamelog_stats
+
+    def iter_player_profiles(self,processes=1,chunksize=16,use_cache=False):
+        # yield (player_record, season_stats, gamelog_stats) for each profile, in file name order.
+        self._check_if_player_profiles_dir_exists()
+        page_store = self._get_page_store(self.player_profiles_dir)
+        cache_dir = self.parse_cache_dir if use_cache else None
+        if processes <= 1:
+            cache = ParseCache(cache_dir) if use_cache else None
+            for file, page in page_store.iter_pages():
+                yield self.scrape_player_page(page,self._make_player_id(file),cache)
+            return
+        pool = multiprocessing.Pool(processes)
+        try:
+            tasks = ((page,self._make_player_id(file),self.engine_name,cache_dir) for file, page in page_store.iter_pages())
+            for result, events in pool.imap(_scrape_player_page,tasks,chunksize): # imap keeps the results in order
+                self.metrics.extend(events)
+                yield result
+        finally:
+            pool.terminate()
+
+    def scrape_player_profiles(self,processes=1,chunksize=16,flush_every=10000,use_cache=False,store='flat',
+                               batch_size=10000):
+        # flush_every is for the flat files, batch_size for SQLite (see FlatFileStore and SQLiteStore)
         self._check_if_player_profiles_dir_exists()
         self._check_if_scraped_player_info_dir_exists()
-        self._clear_output_files()
-        files = os.listdir(self.player_profiles_dir)
-        player_records = []
-        season_stats_records = []
-        gamelog_stats_records = []
-        i = 0
-        for file in files:
-            # provide some output so we know its running
-            i += 1
-            if i % 50 == 0:
-                print "files scraped ",i
-            player_id = i
-            # read the file
-            path = os.path.join(self.player_profiles_dir,file)
-            with open(path,'r') as f:
-                page = f.read().decode("utf8",errors='ignore')
-            # make the soup
-            soup = BeautifulSoup(page,"lxml")
-            # scrape
-            player_record = self.scrape_player_information(soup,player_id)
-            player_records.append(player_record)
-            if 'Season Stats' in page:
-                season_stats = self.scrape_season_stats(soup,player_id)
-                season_stats_records += season_stats
-            for year in ['2012','2013','2014','2015']:
-                if year + ' Gamelog Stats' in page:
-                    gamelog_stats = self.scrape_gamelog_stats(soup,year,player_id)
-                    gamelog_stats_records += gamelog_stats
-
-        self.save_season_stats(season_stats_records)
-        self.save_player_records(player_records)
-        self.save_gamelog_stats(gamelog_stats_records)
+        if store == 'flat':
+            self._clear_output_files()
+            store = FlatFileStore(self,flush_every=flush_every)
+        else:
+            store = STORES[store](self,batch_size=batch_size)
+        try:
+            i = 0
+            for player_record, season_stats, gamelog_stats in self.iter_player_profiles(processes,chunksize,use_cache):
+                # provide some output so we know its running
+                i += 1
+                if i % 50 == 0:
+                    print "files scraped ",i
+                store.write_player(player_record)
+                store.write_season_stats(season_stats)
+                store.write_gamelog_stats(gamelog_stats)
+        finally:
+            store.close()
+        if use_cache:
+            ParseCache(self.parse_cache_dir,self.parse_cache_max_bytes).evict()
 
     def save_player_records(self,player_records):
         output_path = os.path.join(self.scraped_player_info_dir,self.scraped_player_info_file)
-        with open(output_path,'a') as f:
-            for record in player_records:
-                output_string = '\t'.join(record.values())+'\n'
-                f.write(output_string.encode('utf-8'))
+        fields = self._get_player_fields()
+        writer = RecordWriter(output_path)
+        writer.write_all([[record[field] for field in fields] for record in player_records])
+        writer.close()
 
     def save_season_stats(self,season_stats):
         output_path = os.path.join(self.scraped_player_info_dir,self.scraped_season_stats_file)
-        with open(output_path,'a') as f:
-            for record in season_stats:
-                output_string = '\t'.join(record)+'\n'
-                f.write(output_string.encode('utf-8'))
+        writer = RecordWriter(output_path)
+        writer.write_all(season_stats)
+        writer.close()
 
     def save_gamelog_stats(self,gamelog_stats):
         output_path = os.path.join(self.scraped_player_info_dir,self.scraped_gamelog_stats_file)
-        with open(output_path,'a') as f:
-            for record in gamelog_stats:
-                output_string = '\t'.join(record)+'\n'
-                f.write(output_string.encode('utf-8'))
+        writer = RecordWriter(output_path)
+        writer.write_all(gamelog_stats)
+        writer.close()
 
 
 class Cleaner:
@@ -425,9 +1872,23 @@ class Cleaner:
     self.scraped_gamelog_stats
 
     ...and saves the data to the same locations (it OVERWRITES the files).
+
+    clean_stats_data works a column at a time: each distinct value in a column is classified once,
+    with precompiled regular expressions, and the column is then converted with a dictionary lookup.
+    The scraped files are long and narrow, so the columns have few distinct values (player ids,
+    years, stat types, small counts) and most cells never reach the classification at all.
+
+    clean_file streams a file through clean_stats_data 'chunk_size' rows at a time, so memory use
+    doesn't depend on the size of the file. The cleaned rows go to a temporary file which then
+    replaces the original in one rename, so a crash never leaves a half-written file behind.
     """
+    # the same tests as is_numerical and is_null
+    numerical_pattern = re.compile(r'[-,.% ]*[0-9][-,.% 0-9]*\Z')
+    null_pattern = re.compile(r'\s*-*\s*\Z')
+
     def __init__(self):
         self.null_character = '\N'
+        self.metrics = METRICS
         self.scraped_player_info_dir = SCRAPED_PLAYER_INFO
         self.scraped_player_info_file = SCRAPED_PLAYER_INFO_FILE
         self.scraped_season_stats_file = SCRAPED_SEASON_STATS_FILE
@@ -480,24 +1941,46 @@ class Cleaner:
             lines = [line.split('\t') for line in content.split('\n') if line != '']
         return lines
 
+    def iter_stats_data(self,file,chunk_size=100000):
+        # yield the rows of an open file, 'chunk_size' at a time
+        rows = (line.rstrip('\n').split('\t') for line in file if line != '\n')
+        while True:
+            data = list(itertools.islice(rows,chunk_size))
+            if not data:
+                return
+            yield data
+
+    def clean_value(self,value):
+        if self.numerical_pattern.match(value):
+            if '%' in value:
+                return self.clean_percentage(value)
+            elif '.' in value:
+                return self.clean_float(value)
+            else:
+                return self.clean_integer(value)
+        elif self.null_pattern.match(value):
+            return self.null_character
+        else:
+            return value
+
+    def clean_column(self,column):
+        cleaned = dict((value,self.clean_value(value)) for value in set(column))
+        return map(cleaned.__getitem__,column)
+
     def clean_stats_data(self,data):
+        lengths = set(map(len,data))
+        if len(lengths) <= 1:
+            columns = [self.clean_column(column) for column in zip(*data)]
+            data[:] = map(list,zip(*columns))
+            return data
+        # a value with a tab in it makes a row longer than the others. Clean the rows of each length together.
+        row_nums_by_length = {}
         for row_num in range(len(data)):
-            row = data[row_num]
-            for col_num in range(len(row)):
-                value = row[col_num]
-                if self.is_numerical(value):
-                    if self.is_percentage(value):
-                        data[row_num][col_num] = self.clean_percentage(value)
-                    elif self.is_float(value):
-                        data[row_num][col_num] = self.clean_float(value)
-                    elif self.is_integer(value):
-                        data[row_num][col_num] = self.clean_integer(value)
-                    else:
-                        pass
-                elif self.is_null(value):
-                    data[row_num][col_num] = self.null_character
-                else:
-                    pass
+            row_nums_by_length.setdefault(len(data[row_num]),[]).append(row_num)
+        for row_nums in row_nums_by_length.values():
+            columns = [self.clean_column(column) for column in zip(*[data[row_num] for row_num in row_nums])]
+            for row_num, row in zip(row_nums,zip(*columns)):
+                data[row_num] = list(row)
         return data
 
     def get_stat_file_paths(self):
@@ -506,31 +1989,688 @@ class Cleaner:
         paths.append(os.path.join(self.scraped_player_info_dir,self.scraped_gamelog_stats_file))
         return paths
 
-    def save_data(self,data,path):
-        output_string = '\n'.join(['\t'.join([str(val) for val in row]) for row in data]) # ha!
-        with open(path,'w') as f:
-            f.write(output_string)
+    def _format_data(self,data):
+        return '\n'.join(['\t'.join([str(val) for val in row]) for row in data]) # ha!
+
+    def _open_temp_file(self,path):
+        # a temporary file in the same directory as 'path', so it can be renamed over it.
+        directory, name = os.path.split(path)
+        handle, temp_path = tempfile.mkstemp(dir=directory or '.',prefix='.' + name + '.')
+        return os.fdopen(handle,'w'), temp_path
 
-    def clean_data(self):
+    def _replace_file(self,temp_path,path):
+        if os.path.exists(path):
+            shutil.copymode(path,temp_path)
+        os.rename(temp_path,path)
+
+    def save_data(self,data,path):
+        f, temp_path = self._open_temp_file(path)
+        try:
+            with f:
+                f.write(self._format_data(data))
+            self._replace_file(temp_path,path)
+        except:
+            os.remove(temp_path)
+            raise
+
+    def clean_file(self,path,chunk_size=100000):
+        start = time.time()
+        rows = 0
+        f, temp_path = self._open_temp_file(path)
+        try:
+            with f:
+                with open(path,'r') as dirty_file:
+                    separator = ''
+                    for dirty_data in self.iter_stats_data(dirty_file,chunk_size):
+                        rows += len(dirty_data)
+                        clean_data = self.clean_stats_data(dirty_data)
+                        f.write(separator + self._format_data(clean_data))
+                        separator = '\n'
+                f.flush()
+                os.fsync(f.fileno())
+            size = os.path.getsize(path)
+            self._replace_file(temp_path,path)
+        except:
+            os.remove(temp_path)
+            raise
+        self.metrics.record('clean','clean_file',time.time() - start,size,rows,label=path)
+
+    def clean_data(self,chunk_size=100000):
         # clean the stats data...
         for path in self.get_stat_file_paths():
-            dirty_data = self.get_stats_data(path)
-            clean_data = self.clean_stats_data(dirty_data)
-            self.save_data(clean_data,path)
+            self.clean_file(path,chunk_size)
         # clean the player info data...
 
+class ColumnarExporter:
+    """
+    Exports the season and gamelog stats in a wide, typed, columnar form: one row per player and
+    season/team (or per player and game), one float column per stat type, each column a .npy file
+    that loads or memory-maps without any parsing.
+
+    The key columns are integers. player_id, season and week are stored as numbers (-1 where the value
+    isn't a number), and team, opponent and result as codes into a list of categories (-1 for nulls).
+    A missing or non-numerical stat is NaN. The column names, dtypes and categories are in each
+    table's meta.json, and load() puts it all back together.
+
+    Works on the scraped files whether or not the Cleaner has been run. Needs numpy.
+    """
+    # table name -> (source file attribute, key columns as (name, kind))
+    tables = {'season_stats': ('scraped_season_stats_file',
+                               [('player_id','int'),('season','int'),('team','category')]),
+              'gamelog_stats': ('scraped_gamelog_stats_file',
+                                [('player_id','int'),('season','int'),('week','int'),
+                                 ('result','category'),('opponent','category')])}
+    dtypes = {'player_id': 'int64', 'season': 'int16', 'week': 'int16'}
+
+    def __init__(self):
+        self.scraped_player_info_dir = SCRAPED_PLAYER_INFO
+        self.scraped_season_stats_file = SCRAPED_SEASON_STATS_FILE
+        self.scraped_gamelog_stats_file = SCRAPED_GAMELOG_STATS_FILE
+        self.columnar_dir = COLUMNAR_DIR
+        self.cleaner = Cleaner()
+
+    def _check_if_numpy_is_installed(self):
+        if numpy is None:
+            raise Exception("The ColumnarExporter needs numpy. Install it with 'pip install numpy'.")
+
+    def _to_number(self,value):
+        value = self.cleaner.clean_value(value)
+        if isinstance(value,(int,long,float)):
+            return value
+        return None
+
+    def _encode(self,value,kind,categories):
+        if kind == 'int':
+            number = self._to_number(value)
+            return int(number) if number is not None else -1
+        if self.cleaner.is_null(value) or value == self.cleaner.null_character:
+            return -1
+        return categories.setdefault(value,len(categories))
+
+    def _read_table(self,path,key_columns):
+        # pivot the long rows (key..., stat_type, stat_value) into wide rows, keeping the order in
+        # which the keys first appear.
+        categories = dict((name,{}) for name, kind in key_columns if kind == 'category')
+        keys = {}
+        key_values = [[] for each in key_columns]
+        stat_types = {}
+        cells = ([],[],[]) # row numbers, stat numbers, values
+        with open(path,'r') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != len(key_columns) + 2:
+                    continue
+                key = tuple(fields[:-2])
+                row = keys.get(key)
+                if row is None:
+                    row = keys[key] = len(keys)
+                    for i, (name, kind) in enumerate(key_columns):
+                        key_values[i].append(self._encode(key[i],kind,categories.get(name)))
+                value = self._to_number(fields[-1])
+                if value is not None:
+                    cells[0].append(row)
+                    cells[1].append(stat_types.setdefault(fields[-2],len(stat_types)))
+                    cells[2].append(value)
+        return len(keys), key_values, categories, stat_types, cells
+
+    def _sorted_categories(self,codes):
+        return [value for value, code in sorted(codes.items(),key=lambda item: item[1])]
+
+    def export_table(self,table):
+        self._check_if_numpy_is_installed()
+        file_attribute, key_columns = self.tables[table]
+        path = os.path.join(self.scraped_player_info_dir,getattr(self,file_attribute))
+        n_rows, key_values, categories, stat_types, cells = self._read_table(path,key_columns)
+        output_dir = os.path.join(self.columnar_dir,table)
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        meta = {'rows': n_rows, 'key_columns': [], 'stat_columns': []}
+        for (name, kind), values in zip(key_columns,key_values):
+            dtype = self.dtypes.get(name,'int32')
+            numpy.save(os.path.join(output_dir,name + '.npy'),numpy.array(values,dtype=dtype))
+            column = {'name': name, 'file': name + '.npy', 'dtype': dtype}
+            if kind == 'category':
+                column['categories'] = self._sorted_categories(categories[name])
+            meta['key_columns'].append(column)
+        stats = numpy.full((len(stat_types),n_rows),numpy.nan)
+        stats[numpy.array(cells[1],dtype='int64'),numpy.array(cells[0],dtype='int64')] = cells[2]
+        for number, stat_type in enumerate(self._sorted_categories(stat_types)):
+            file = 'stat_%03d.npy' % number
+            numpy.save(os.path.join(output_dir,file),stats[number])
+            meta['stat_columns'].append({'name': stat_type, 'file': file, 'dtype': 'float64'})
+        with open(os.path.join(output_dir,'meta.json'),'w') as f:
+            json.dump(meta,f,indent=1)
+
+    def export(self):
+        for table in sorted(self.tables):
+            self.export_table(table)
+
+    def load(self,table,mmap_mode='r'):
+        # {column name: array} and {column name: categories}. The arrays are memory-mapped by default.
+        self._check_if_numpy_is_installed()
+        directory = os.path.join(self.columnar_dir,table)
+        with open(os.path.join(directory,'meta.json'),'r') as f:
+            meta = json.load(f)
+        columns = {}
+        categories = {}
+        for column in meta['key_columns'] + meta['stat_columns']:
+            columns[column['name']] = numpy.load(os.path.join(directory,column['file']),mmap_mode=mmap_mode)
+            if 'categories' in column:
+                categories[column['name']] = column['categories']
+        return columns, categories
+
+class StatsStore:
+    """
+    An in-memory copy of the scraped player info, season stats and gamelog stats, indexed for
+    answering queries without going back to the files. load() reads the files (cleaned or not) and
+    types the values with the Cleaner's rules: numbers become ints and floats, and '\N' and empty
+    values become None.
+
+    Each table is kept as columns, and the indexes map every value of player_id, season, week,
+    team, opponent and stat_type to the row numbers that have it. A query starts from its most
+    selective indexed condition and checks the other conditions on those rows only, so it touches a
+    few hundred rows rather than millions. Results are cached (up to 'cache_size' of them), so a
+    repeated query is a dictionary lookup.
+
+    store = StatsStore()
+    store.load()
+    store.select('gamelog_stats',player_id=1013,season=2014,stat_type='Rush_Yard')
+    store.select('gamelog_stats',player_id=1013,week=(1,4))   # an inclusive range
+    store.top('season_stats','Rec_Yard',10,season=2014)       # the 10 highest values
+    store.player(1013)
+
+    Rows are tuples in the column order of their table (see 'tables').
+    """
+    # table name -> (source file attribute, columns)
+    tables = {'season_stats': ('scraped_season_stats_file',
+                               ['player_id','season','team','stat_type','stat_value']),
+              'gamelog_stats': ('scraped_gamelog_stats_file',
+                                ['player_id','season','week','result','opponent','stat_type','stat_value'])}
+    indexed_columns = set(['player_id','season','week','team','opponent','stat_type'])
+
+    def __init__(self,cache_size=1024):
+        self.scraped_player_info_dir = SCRAPED_PLAYER_INFO
+        self.scraped_player_info_file = SCRAPED_PLAYER_INFO_FILE
+        self.scraped_season_stats_file = SCRAPED_SEASON_STATS_FILE
+        self.scraped_gamelog_stats_file = SCRAPED_GAMELOG_STATS_FILE
+        self.cleaner = Cleaner()
+        self.cache_size = cache_size
+        self.cache = {}
+        self.players = {}
+        self.columns = {} # table -> {column name: list of values}
+        self.indexes = {} # table -> {column name: {value: list of row numbers}}
+        self.sorted_keys = {} # table -> {column name: the index's values, sorted, for range queries}
+
+    def _type_value(self,value,typed):
+        # typed remembers the values seen so far, so each distinct string is cleaned once
+        if value not in typed:
+            cleaned = self.cleaner.clean_value(value)
+            if cleaned == self.cleaner.null_character:
+                cleaned = None
+            elif isinstance(cleaned,basestring):
+                cleaned = _intern_text(cleaned.strip())
+            typed[value] = cleaned
+        return typed[value]
+
+    def _load_players(self):
+        path = os.path.join(self.scraped_player_info_dir,self.scraped_player_info_file)
+        self.players = {}
+        with open(path,'r') as f:
+            for line in f:
+                values = line.rstrip('\n').decode('utf-8').split('\t')
+                if len(values) != len(PlayerRecord.fields):
+                    continue
+                player_record = PlayerRecord(0)
+                player_record.__setstate__(values)
+                self.players[int(player_record['id'])] = player_record
+
+    def _load_table(self,table):
+        file_attribute, names = self.tables[table]
+        path = os.path.join(self.scraped_player_info_dir,getattr(self,file_attribute))
+        columns = [[] for name in names]
+        typed = {}
+        with open(path,'r') as f:
+            for line in f:
+                values = line.rstrip('\n').decode('utf-8').split('\t')
+                if len(values) != len(names): # a stray tab in a value
+                    continue
+                for column, value in zip(columns,values):
+                    column.append(self._type_value(value,typed))
+        self.columns[table] = dict(zip(names,columns))
+        self.indexes[table] = {}
+        self.sorted_keys[table] = {}
+        for name, column in zip(names,columns):
+            if name not in self.indexed_columns:
+                continue
+            index = {}
+            for row, value in enumerate(column):
+                if value is not None:
+                    index.setdefault(value,[]).append(row)
+            self.indexes[table][name] = index
+            self.sorted_keys[table][name] = sorted(index)
+
+    def load(self):
+        self._load_players()
+        for table in sorted(self.tables):
+            self._load_table(table)
+        self.cache = {}
+        return self
+
+    def _check_columns(self,table,columns):
+        if table not in self.columns:
+            raise Exception("There's no table named %r, or it hasn't been loaded. Run the StatsStore's 'load' method first." % table)
+        for column in columns:
+            if column not in self.columns[table]:
+                raise Exception("The %s table has no column named %r" % (table,column))
+
+    def _matches(self,value,condition):
+        if isinstance(condition,tuple):
+            low, high = condition
+            return value is not None and (low is None or value >= low) and (high is None or value <= high)
+        return value == condition
+
+    def _postings(self,table,column,condition):
+        # the index's lists of row numbers that meet the condition
+        index = self.indexes[table][column]
+        if not isinstance(condition,tuple):
+            return [index.get(condition,[])]
+        keys = self.sorted_keys[table][column]
+        low, high = condition
+        start = 0 if low is None else bisect.bisect_left(keys,low)
+        end = len(keys) if high is None else bisect.bisect_right(keys,high)
+        return [index[key] for key in keys[start:end]]
+
+    def _find(self,table,conditions):
+        # the row numbers that meet all the conditions, in file order
+        self._check_columns(table,conditions)
+        columns = self.columns[table]
+        best = None
+        for column, condition in conditions.items():
+            if column in self.indexes[table]:
+                postings = self._postings(table,column,condition)
+                size = sum(map(len,postings))
+                if best is None or size < best[0]:
+                    best = (size,column,postings)
+        if best is None:
+            rows = xrange(len(columns[self.tables[table][1][0]]))
+            remaining = conditions.items()
+        else:
+            size, column, postings = best
+            rows = postings[0] if len(postings) == 1 else sorted(itertools.chain(*postings))
+            remaining = [(name, condition) for name, condition in conditions.items() if name != column]
+        for name, condition in remaining:
+            values = columns[name]
+            if isinstance(condition,tuple):
+                rows = [row for row in rows if self._matches(values[row],condition)]
+            else:
+                rows = [row for row in rows if values[row] == condition]
+        return rows
+
+    def _make_rows(self,table,rows):
+        columns = self.columns[table]
+        return tuple(zip(*[map(columns[name].__getitem__,rows) for name in self.tables[table][1]]))
+
+    def _cached(self,key,function,*args):
+        if key not in self.cache:
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            self.cache[key] = function(*args)
+        return self.cache[key]
+
+    def _select(self,table,conditions):
+        return self._make_rows(table,self._find(table,conditions))
+
+    def select(self,table,**conditions):
+        # The rows of 'table' that meet all the conditions, in file order. A condition is
+        # column=value, or column=(low,high) for an inclusive range, where None leaves a side open.
+        key = ('select',table,tuple(sorted(conditions.items())))
+        return self._cached(key,self._select,table,conditions)
+
+    def _top(self,table,k,conditions):
+        values = self.columns[table]['stat_value']
+        rows = [row for row in self._find(table,conditions) if values[row] is not None]
+        return self._make_rows(table,heapq.nlargest(k,rows,key=values.__getitem__))
+
+    def top(self,table,stat_type,k=10,**conditions):
+        # the k rows of 'table' with the highest values of 'stat_type' that meet the conditions,
+        # highest first
+        conditions['stat_type'] = stat_type
+        key = ('top',table,k,tuple(sorted(conditions.items())))
+        return self._cached(key,self._top,table,k,conditions)
+
+    def distinct(self,table,column):
+        # the sorted values of an indexed column, e.g. all the seasons
+        self._check_columns(table,[column])
+        if column not in self.sorted_keys[table]:
+            raise Exception("The %s column of the %s table isn't indexed" % (column,table))
+        return list(self.sorted_keys[table][column])
+
+    def player(self,player_id):
+        # the player's PlayerRecord, or None
+        return self.players.get(int(player_id))
+
+
+def _run_local_shard(crawl,directory,shard,player_index,delay):
+    # module-level, so that multiprocessing can pickle it.
+    os.chdir(directory)
+    crawl.run_shard(shard,player_index,delay)
+
+
+class ShardedCrawl:
+    """
+    Splits the whole crawl across several machines. The player list is partitioned into num_shards
+    shards by a hash of each profile's url (shard_for), so every node works out the same partition on
+    its own, without talking to the others.
+
+    1) On node k, in its own working directory: ShardedCrawl(num_shards).run_shard(k)
+       This downloads the player listings and the profiles of shard k, then scrapes and cleans them
+       into the node's scraped_player_info directory: its partition of the output.
+    2) Gather the partitions on one machine: ShardedCrawl(num_shards).merge(partition_dirs)
+       Player ids are fftoday's own player numbers (see Scraper._make_player_id), so they're the same
+       whichever node scraped the player, and merging is a matter of concatenating the partitions.
+
+    run_local() does all of this on one machine, with a process and a working directory per shard,
+    which is handy for trying it out. The listings are then downloaded once, in 'root', and the shards
+    split the rate limit between them. base_url points the Downloaders somewhere other than fftoday, and
+    page_store picks how each node keeps its pages (see PAGE_STORES).
+    """
+    def __init__(self,num_shards,delay=5,workers=1,processes=1,engine='soup',monitor=False,base_url=None,
+                 page_store='directory'):
+        self.num_shards = num_shards
+        self.page_store = page_store
+        self.delay = delay
+        self.workers = workers
+        self.processes = processes
+        self.engine = engine
+        self.monitor = monitor
+        self.base_url = base_url
+        self.output_files = [SCRAPED_PLAYER_INFO_FILE,SCRAPED_SEASON_STATS_FILE,SCRAPED_GAMELOG_STATS_FILE]
+
+    def _make_downloader(self):
+        downloader = Downloader(self.page_store)
+        if self.base_url:
+            downloader.base_url = self.base_url
+        return downloader
+
+    def run_shard(self,shard,player_index=None,delay=None):
+        # player_index saves downloading and parsing the listings again, and delay replaces self.delay
+        # for the profiles (see run_local).
+        downloader = self._make_downloader()
+        scraper = Scraper(self.engine,self.page_store)
+        if player_index is None:
+            downloader.download_player_listings(self.delay,self.monitor)
+            player_index = scraper.index_player_listings(self.processes)
+        if delay is None:
+            delay = self.delay
+        downloader.download_player_profiles(delay,self.monitor,self.workers,shard=shard,num_shards=self.num_shards,
+                                            player_index=player_index)
+        scraper.scrape_player_profiles(self.processes)
+        Cleaner().clean_data()
+
+    def merge(self,partition_dirs,output_dir=SCRAPED_PLAYER_INFO):
+        # concatenate the partitions' files, in the order given, into output_dir
+        if not os.path.exists(output_dir):
+            os.mkdir(output_dir)
+        for file in self.output_files:
+            output_path = os.path.join(output_dir,file)
+            temp_path = output_path + '.tmp'
+            with open(temp_path,'w') as output_file:
+                for directory in partition_dirs:
+                    with open(os.path.join(directory,file),'r') as partition_file:
+                        for line in partition_file:
+                            if line.endswith('\n'):
+                                output_file.write(line)
+                            elif line:
+                                output_file.write(line + '\n') # the Cleaner leaves no newline at the end
+            os.rename(temp_path,output_path)
+
+    def _index_player_listings(self,directory):
+        # download and parse the listings once, in 'directory'
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            self._make_downloader().download_player_listings(self.delay,self.monitor)
+            return Scraper(self.engine,self.page_store).index_player_listings(self.processes)
+        finally:
+            os.chdir(cwd)
+
+    def run_local(self,root='shards',output_dir=SCRAPED_PLAYER_INFO):
+        # The shards share this machine's connection to the site, so the listings are downloaded once
+        # for all of them, and each shard gets 1/num_shards of the request rate: together they make
+        # one request every 'delay' seconds, as a single Downloader would.
+        directories = [os.path.abspath(os.path.join(root,'shard_%d' % shard)) for shard in range(self.num_shards)]
+        for directory in directories:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+        player_index = self._index_player_listings(root)
+        delay = self.delay * self.num_shards
+        workers = [multiprocessing.Process(target=_run_local_shard,args=(self,directory,shard,player_index,delay))
+                   for shard, directory in enumerate(directories)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        failed = [shard for shard, worker in enumerate(workers) if worker.exitcode != 0]
+        if failed:
+            raise Exception("These shards failed: %s" % failed)
+        self.merge([os.path.join(directory,SCRAPED_PLAYER_INFO) for directory in directories],output_dir)
+
+
+class _ImmediateResult:
+    # the result of a call made right away, with the same get() as the pool's AsyncResult
+    def __init__(self,function,*args):
+        self.value = None
+        self.exception = None
+        try:
+            self.value = function(*args)
+        except Exception as e:
+            self.exception = e
+
+    def get(self):
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+
+class Pipeline:
+    """
+    Runs the Downloader, Scraper and Cleaner as overlapping stages instead of one after the other:
+
+    download threads -> page queue -> parser processes -> record queue -> cleaner/writer thread
+
+    Each profile is parsed as soon as it has been downloaded, and its records are cleaned and written
+    as soon as they have been parsed, so waiting on the network and parsing happen at the same time.
+    The queues are bounded: when a stage falls behind, the stages feeding it wait, instead of pages or
+    records piling up in memory.
+
+    The pages are still saved (and recorded in the manifest) as usual, so a batch scrape of the saved
+    pages can always be run afterwards. The output files hold the same rows as the batch mode's, but
+    in the order the profiles finished downloading rather than in file name order, and each file ends
+    with a newline (the Cleaner's output doesn't).
+
+    If a download thread or the cleaner/writer thread fails (a page or a store that can't be written,
+    say), the other stages are stopped and run() raises that thread's exception.
+    """
+    def __init__(self,engine='soup',queue_size=64,page_store='directory'):
+        self.downloader = Downloader(page_store)
+        self.scraper = Scraper(engine,page_store)
+        self.cleaner = Cleaner()
+        self.queue_size = queue_size
+        self.failures = 0
+        self.error = None
+        self.error_lock = threading.Lock()
+
+    def _fail(self,abort):
+        # called by a failing thread: keep the first exception for run() to raise, and stop the rest
+        with self.error_lock:
+            if self.error is None:
+                self.error = sys.exc_info()
+        abort.set()
+
+    def _put(self,queue,item,abort):
+        # queue.put that gives up when the run is being aborted, so a full queue can't hang a thread
+        while not abort.is_set():
+            try:
+                queue.put(item,timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _get(self,queue,abort):
+        # queue.get that returns None when the run is being aborted
+        while not abort.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        return None
+
+    def _download_pages(self,urls,pages,monitor,retries,backoff,abort):
+        # download thread: take urls until there are none left. Failed downloads are logged by the
+        # Downloader, but anything else (a page that can't be saved, say) stops the run.
+        try:
+            while not abort.is_set():
+                try:
+                    url = urls.get_nowait()
+                except Queue.Empty:
+                    return
+                page = self.downloader._download(self.downloader._make_request(url),self.downloader.player_profiles_dir,retries,backoff,
+                                                 return_page=True)
+                if monitor:
+                    print url
+                if page is not None:
+                    if not self._put(pages,(self.downloader._make_output_file(url),page),abort):
+                        return
+        except Exception:
+            self._fail(abort)
+
+    def _clean_records(self,records):
+        start = time.time()
+        # every column gets the same cleaning, so each distinct string only needs cleaning once
+        records = records.map(lambda value: unicode(self.cleaner.clean_value(value)))
+        self.cleaner.metrics.record('clean','clean_records',time.time() - start,items=len(records))
+        return records
+
+    def _write_records(self,results,store_name,abort):
+        # cleaner/writer thread. The store is made and closed here, because a SQLite connection can
+        # only be used by the thread that opened it. Any error stops the run.
+        try:
+            store = STORES[store_name](self.scraper)
+            try:
+                while True:
+                    item = self._get(results,abort)
+                    if item is None:
+                        return
+                    file, result = item
+                    try:
+                        (player_record, season_stats, gamelog_stats), events = result.get()
+                        self.scraper.metrics.extend(events)
+                    except Exception as e:
+                        # one odd profile shouldn't stop the whole run
+                        self.failures += 1
+                        print "could not scrape %s: %r" % (file,e)
+                        continue
+                    store.write_player(player_record)
+                    store.write_season_stats(self._clean_records(season_stats))
+                    store.write_gamelog_stats(self._clean_records(gamelog_stats))
+            finally:
+                store.close()
+        except Exception:
+            self._fail(abort)
+
+    def run(self,delay=5,monitor=False,workers=4,processes=2,retries=3,backoff=2,store='flat',use_cache=False):
+        # the player listings are needed before anything else can start, and there are only a few.
+        self.downloader.download_player_listings(delay,monitor)
+        self.downloader._set_rate_limit(delay)
+        urls = Queue.Queue()
+        for href in self.scraper.index_player_listings(processes).hrefs():
+            urls.put(self.downloader.base_url + href)
+
+        self.scraper._check_if_scraped_player_info_dir_exists()
+        if store == 'flat':
+            self.scraper._clear_output_files()
+        cache_dir = self.scraper.parse_cache_dir if use_cache else None
+        pages = Queue.Queue(self.queue_size)
+        results = Queue.Queue(self.queue_size)
+        abort = threading.Event()
+        self.error = None
+        self.failures = 0
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+
+        downloaders = [threading.Thread(target=self._download_pages,args=(urls,pages,monitor,retries,backoff,abort))
+                       for each in range(workers)]
+        writer = threading.Thread(target=self._write_records,args=(results,store,abort))
+        def end_of_pages():
+            for thread in downloaders:
+                thread.join()
+            self._put(pages,None,abort)
+        for thread in downloaders + [writer,threading.Thread(target=end_of_pages)]:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            # the parser stage runs here, handing the pages to the pool. The pool's results go to the
+            # writer in the order they were submitted.
+            i = 0
+            while True:
+                item = self._get(pages,abort)
+                if item is None:
+                    break
+                file, page = item
+                task = (page,self.scraper._make_player_id(file),self.scraper.engine_name,cache_dir)
+                if pool:
+                    result = pool.apply_async(_scrape_player_page,(task,))
+                else:
+                    result = _ImmediateResult(_scrape_player_page,task)
+                if not self._put(results,(file,result),abort):
+                    break
+                i += 1
+                if i % 50 == 0:
+                    print "files scraped ",i
+            self._put(results,None,abort)
+            writer.join()
+        except:
+            abort.set()
+            writer.join() # the writer closes the store
+            raise
+        finally:
+            if pool:
+                pool.terminate()
+            self.downloader._close_page_stores()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        if use_cache:
+            ParseCache(self.scraper.parse_cache_dir,self.scraper.parse_cache_max_bytes).evict()
+        self.downloader.manifest.compact()
+        if self.failures:
+            print "%d profiles could not be scraped" % self.failures
+
 if __name__ == "__main__":
     # NOTE ABOUT USAGE:
     # Run the download portion of the script only once. Once you have the html files on your disk,
     # comment the download portion out. You can scrape the local files multiple times to work out
     # your scraping methods.
+    #
+    # The profiles fetched in the last day are skipped (see max_age), so running the script again
+    # after an interrupted download picks up where it stopped instead of starting over.
+    #
+    # 'python scrape.py pipeline' runs the download, scrape and clean stages at the same time instead
+    # (see Pipeline).
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'pipeline':
+        print "downloading, scraping and cleaning..."
+        pipeline = Pipeline()
+        pipeline.run(delay=3,monitor=True)
+        METRICS.write_json('metrics.json')
+        sys.exit()
 
     ## download
     downloader = Downloader()
     print "downloading player listings..."
     downloader.download_player_listings(delay=3,monitor=True) # use a 3 second delay between http requests, and print the url so we have something to see.
     print "downloading player profiles..."
-    downloader.download_player_profiles(delay=3,monitor=True)
+    downloader.download_player_profiles(delay=3,monitor=True,max_age=24*60*60)
 
     ## parse
     print "scraping data from downloaded files..."
@@ -541,3 +2681,5 @@ if __name__ == "__main__":
     print "cleaning up the data..."
     cleaner = Cleaner()
     cleaner.clean_data()
+
+    METRICS.write_json('metrics.json')